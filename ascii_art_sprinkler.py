@@ -1,13 +1,37 @@
 #!/usr/bin/python3
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import io
+import os
+import json
 import re
+import bz2
+import gzip
+import lzma
 import sys
+import heapq
+import bisect
 import random
+import mmap
+import time
+import struct
+import queue
+import shutil
+import hashlib
+import tempfile
 import argparse
-from dataclasses import dataclass
+import functools
+import contextlib
+import itertools
+import threading
+from dataclasses import dataclass, field, replace
+from multiprocessing import shared_memory, resource_tracker
 from typing import TextIO, Iterable, Tuple, Callable, List, Dict, Union
-from typing import NoReturn, TypeVar
+from typing import NoReturn, TypeVar, BinaryIO, Protocol, Any, cast
+from typing import Sequence, Iterator, Literal
+
+
+Iterated = TypeVar("Iterated")
 
 
 @dataclass
@@ -76,23 +100,145 @@ class Rect:
         return None
 
 
+class KeyedRandomStream:
+    """Random draws of a KeyedRandom for a single key
+
+    Implements the subset of random.Random used to sprinkle art."""
+    __slots__ = ("_random", "_key", "_block", "_draws", "_next_draw")
+
+    def __init__(self, keyed_random: "KeyedRandom", key: Tuple[int, ...]):
+        self._random = keyed_random
+        self._key = key
+        self._block = 0
+        self._draws = keyed_random.draws(key + (0,))
+        self._next_draw = 0
+
+    def _next(self) -> int:
+        """Return the next 64-bit unsigned random number"""
+        if self._next_draw == len(self._draws):
+            self._block += 1
+            self._draws = self._random.draws(self._key + (self._block,))
+            self._next_draw = 0
+        self._next_draw += 1
+        return self._draws[self._next_draw - 1]
+
+    def random(self) -> float:
+        """Return a float in [0, 1)"""
+        return (self._next() >> 11) / (1 << 53)
+
+    def randint(self, a: int, b: int) -> int:
+        """Return an integer in [a, b]"""
+        return a + self._next() % (b - a + 1)
+
+    def choice(self, seq: Sequence[Iterated]) -> Iterated:
+        """Return a random element of a non-empty sequence"""
+        return seq[self._next() % len(seq)]
+
+    def choices(self, population: Sequence[Iterated], *,
+                cum_weights: Sequence[float]) -> List[Iterated]:
+        """Return a list of one element chosen according to cum_weights"""
+        index = bisect.bisect(cum_weights, self.random() * cum_weights[-1],
+                              0, len(population) - 1)
+        return [population[index]]
+
+
+class KeyedRandom:
+    """A counter-based random source
+
+    Random numbers are a hash of the seed and of a key, such as the
+    coordinates of a blank and an attempt number.  Unlike random.Random,
+    the numbers drawn for a key do not depend on what was drawn before, so
+    the result does not depend on the order in which keys are used."""
+
+    DRAWS = struct.Struct("<8Q")
+
+    def __init__(self, seed: Union[int, None] = None):
+        """Create a random source.  If seed is None, use a random seed."""
+        if seed is None:
+            seed = int.from_bytes(os.urandom(16), "little")
+        hash_key = hashlib.blake2b(str(seed).encode(),
+                                   digest_size=32).digest()
+        # copied for each hash, which is cheaper than keying a new one
+        self._keyed_hash = hashlib.blake2b(key=hash_key)
+
+    def digest(self, key: Tuple[int, ...]) -> bytes:
+        """Return the 64-byte hash of the seed and the given key"""
+        keyed_hash = self._keyed_hash.copy()
+        keyed_hash.update(struct.pack(f"<{len(key)}q", *key))
+        return keyed_hash.digest()
+
+    def draws(self, key: Tuple[int, ...]) -> Tuple[int, ...]:
+        """Return the eight 64-bit numbers derived from the given key"""
+        return self.DRAWS.unpack(self.digest(key))
+
+    def stream(self, *key: int) -> KeyedRandomStream:
+        """Return the random draws for the given key"""
+        return KeyedRandomStream(self, key)
+
+
+RandomSource = Union[random.Random, KeyedRandomStream]
+
+
 def random_subrectangle(rect: Rect, new_size_x: int, new_size_y: int,
-                        rand: random.Random) -> Rect:
+                        rand: RandomSource) -> Rect:
     """Given a rectangle, randomly select a smaller rectangle inside it
 
     The smaller subrectangle will have size (new_size_x, new_size_y)
+
+    If new_size_x (or new_size_y) is larger than the rectangle, then the
+    selected rectangle will contain the rectangle on this axis instead.
     """
-    x_start = rand.randint(rect.x_start, rect.x_end - new_size_x)
-    y_start = rand.randint(rect.y_start, rect.y_end - new_size_y)
+    x_bounds = sorted((rect.x_start, rect.x_end - new_size_x))
+    y_bounds = sorted((rect.y_start, rect.y_end - new_size_y))
+    x_start = rand.randint(x_bounds[0], x_bounds[1])
+    y_start = rand.randint(y_bounds[0], y_bounds[1])
     return Rect(x_start, x_start + new_size_x, y_start, y_start + new_size_y)
 
 
+_INK_RE = re.compile("[^ ]+")
+
+
+def ink_mask(text: str) -> int:
+    """Return a bitmask of the non-space characters of text
+
+    Bit 0 is the first character of text."""
+    mask = 0
+    for match in _INK_RE.finditer(text):
+        mask |= ((1 << (match.end() - match.start())) - 1) << match.start()
+    return mask
+
+
+class ReadOnlyCanvas(Protocol):
+    """The read-only part of AsciiCanvas, which is all that is needed to
+    sprinkle an art."""
+    def width(self) -> int:
+        """Return the width of the canvas"""
+
+    def height(self) -> int:
+        """Return the height of the canvas"""
+
+    def line(self, y: int, justified: bool = True) -> str:
+        """Return a line of the canvas as a string"""
+
+    def transparency(self) -> Union[int, None]:
+        """Return None if the canvas is opaque, else its transparency margin
+        """
+
+    def transparency_masks(self) -> Union[List[int], None]:
+        """Return None if the canvas is opaque, else its line bitmasks"""
+
+
 class AsciiCanvas:
     "A canvas for ASCII art."
     def __init__(self, width: int, height: int):
         self._width: int = width
         # lines internally have a dynamic width, still below self.width
         self._lines: List[str] = ["" for x in range(height)]
+        # ink_mask() of each line, None until it is needed
+        self._ink: List[Union[int, None]] = [0] * height
+        # None if opaque, else the margin kept around non-space characters
+        self._transparency: Union[int, None] = None
+        self._masks: List[int] = []
 
     def width(self) -> int:
         """Return the width of the canvas"""
@@ -114,6 +260,65 @@ class AsciiCanvas:
             return self._lines[y].ljust(self._width)
         return self._lines[y]
 
+    def transparency(self) -> Union[int, None]:
+        """Return None if the canvas is opaque.
+
+        If the canvas is transparent, return the margin kept around its
+        non-space characters.  See make_transparent()."""
+        return self._transparency
+
+    def transparency_masks(self) -> Union[List[int], None]:
+        """Return None if the canvas is opaque.
+
+        If the canvas is transparent, return a bitmask for each line, of the
+        columns which must be blank to draw this canvas over another.
+        Bit 0 is column 0."""
+        if self._transparency is None:
+            return None
+        return self._masks
+
+    def make_transparent(self, margin: int) -> None:
+        """Make the spaces of this canvas transparent
+
+        When drawn over another canvas, only non-space characters will be
+        drawn.  Only these characters and the given margin around them must
+        be blank, which allows to draw over text using the spaces of the
+        canvas."""
+        assert margin >= 0
+        self._transparency = margin
+        self._update_transparency_masks()
+
+    def _update_masks(self) -> None:
+        """Update the line bitmasks after the whole canvas changed"""
+        self._ink = [None] * len(self._lines)
+        self._update_transparency_masks()
+
+    def _line_ink(self, y: int) -> int:
+        """Return the ink_mask() of a line, computing it if needed"""
+        ink = self._ink[y]
+        if ink is None:
+            ink = self._ink[y] = ink_mask(self._lines[y])
+        return ink
+
+    def _update_transparency_masks(self) -> None:
+        """Update transparency_masks() from the line bitmasks"""
+        if self._transparency is None:
+            return
+        margin = self._transparency
+        full = (1 << self._width) - 1
+        row_masks = []
+        for y in range(len(self._lines)):
+            mask = self._line_ink(y)
+            for _ in range(margin):
+                mask |= (mask << 1) | (mask >> 1)
+            row_masks.append(mask & full)
+        self._masks = []
+        for y in range(len(row_masks)):
+            mask = 0
+            for row_mask in row_masks[max(0, y - margin):y + margin + 1]:
+                mask |= row_mask
+            self._masks.append(mask)
+
     def rectangle_in_canvas(self, rect: Rect) -> bool:
         """Returns true if this rectangle fits in the canvas.
 
@@ -143,10 +348,25 @@ class AsciiCanvas:
                 return False
         return True
 
+    def is_rectangle_free_under(self, rect: Rect, masks: List[int]) -> bool:
+        """Like is_rectangle_free(), but only check some columns of the rect
+
+        masks contains a bitmask for each line of the rectangle.  Bit 0 is
+        the column rect.x_start."""
+        if not self.rectangle_in_canvas(rect):
+            return False
+        for y, mask in zip(range(rect.y_start, rect.y_end), masks):
+            if (self._line_ink(y) >> rect.x_start) & mask:
+                return False
+        return True
+
     def clone(self) -> "AsciiCanvas":
         """Create a deep clone of this object"""
         ret = AsciiCanvas(self._width, 0)
         ret._lines = self._lines[:]
+        ret._ink = self._ink[:]
+        ret._transparency = self._transparency
+        ret._masks = self._masks[:]
         return ret
 
     @classmethod
@@ -158,6 +378,7 @@ class AsciiCanvas:
         width = max((len(line) for line in lines), default=0)
         ret = cls(width, 0)
         ret._lines = list(lines)
+        ret._update_masks()
         return ret
 
     @classmethod
@@ -177,6 +398,7 @@ class AsciiCanvas:
 
         for y, line in enumerate(self._lines):
             self._lines[y] = invert_line(line)
+        self._update_masks()
 
     def mirror_y(self, map_function: Callable[[str], str]) -> None:
         """Mirror the content by the x axis, i.e. top-to-bottom
@@ -186,23 +408,33 @@ class AsciiCanvas:
         self._lines.reverse()
         for y, line in enumerate(self._lines):
             self._lines[y] = "".join(map_function(c) for c in line)
+        self._update_masks()
 
-    def blit(self, src: "AsciiCanvas", dest_x: int, dest_y: int) -> None:
+    def blit(self, src: ReadOnlyCanvas, dest_x: int, dest_y: int) -> None:
         """Copy src at position (dest_x, dest_y).
 
-        This will overwrite any character at this location.  Trying to
-        blit art outside of the canvas is an error."""
+        This will overwrite any character at this location, except if src
+        is transparent, in which case only non-space characters of src are
+        copied.  Trying to blit art outside of the canvas is an error."""
         if not self.rectangle_in_canvas(Rect(dest_x, dest_x + src.width(),
                                              dest_y, dest_y + src.height())):
             raise IndexError("Coordinates out of bounds")
+        transparent = src.transparency() is not None
         for y in range(src.height()):
             line = self._lines[dest_y + y]
             line = line.ljust(dest_x)
             left = line[:dest_x]
             right = line[dest_x + src.width():]
-            middle = src.line(y, justified=bool(right))
+            if transparent:
+                below = line[dest_x:dest_x + src.width()].ljust(src.width())
+                middle = "".join(c if c != " " else b
+                                 for c, b in zip(src.line(y), below))
+            else:
+                middle = src.line(y, justified=bool(right))
             line = "{}{}{}".format(left, middle, right)
             self._lines[dest_y + y] = line
+            self._ink[dest_y + y] = None
+        self._update_transparency_masks()
 
     def increase_size(self, width: int, height: int) -> None:
         """Increase the size of the canvas by padding on the bottom right
@@ -211,14 +443,19 @@ class AsciiCanvas:
         if width < self.width() or height < self.height():
             raise IndexError("New size is smaller than old size")
         self._width = width
+        self._ink.extend(0 for y in range(height - self.height()))
         self._lines.extend("" for y in range(height - self.height()))
+        self._update_transparency_masks()
 
     def remove_lines_at_top(self, height: int) -> "AsciiCanvas":
         """Remove n lines from the top and return them as a new canvas"""
         assert height <= self.height()
         ret = AsciiCanvas(self._width, 0)
         ret._lines = self._lines[:height]
+        ret._ink = self._ink[:height]
         self._lines = self._lines[height:]
+        self._ink = self._ink[height:]
+        self._update_transparency_masks()
         return ret
 
     def add_line(self, line: str, allow_resize_width: bool) -> None:
@@ -234,6 +471,8 @@ class AsciiCanvas:
             else:
                 raise ValueError("Line is too long")
         self._lines.append(line)
+        self._ink.append(None)
+        self._update_transparency_masks()
 
     def add_margin(self, margin: int) -> None:
         """Add a given amount of margin on all four borders"""
@@ -246,6 +485,7 @@ class AsciiCanvas:
         for _ in range(margin):
             self._lines.insert(0, "")
         self._lines.extend("" for i in range(margin))
+        self._update_masks()
 
     def write(self, output: TextIO) -> None:
         """Print the content of this canvas to a file-like object"""
@@ -292,6 +532,7 @@ class ArtParser:
         self._current_art: List[str] = []
         self._lineno = 0
         self._margin = 1
+        self._transparent = False
 
     def make_transpose_dictionnary(self, definition: str) -> Dict[str, str]:
         """Make a dictionary from str to str from a mirror_* definition"""
@@ -345,6 +586,10 @@ class ArtParser:
             self._next_height = val
         elif (val := self._parse_int_option("margin", command, 0)) is not None:
             self._margin = val
+        elif command == "transparent":
+            self._transparent = True
+        elif command == "opaque":
+            self._transparent = False
         elif command.startswith("mirror_x:"):
             command = command[len("mirror_x:"):].lstrip(" ")
             self._transpose_x = self.make_transpose_dictionnary(command)
@@ -428,8 +673,12 @@ class ArtParser:
 
         art.add_margin(self._margin)
 
+        first_art = len(self._arts)
         self._arts.append(art)
         self._try_add_mirrored_art(art)
+        if self._transparent:
+            for added_art in self._arts[first_art:]:
+                added_art.make_transparent(self._margin)
 
     def _try_add_mirrored_art(self, art: AsciiCanvas) -> None:
         """Try to mirror the art horizontally, vertically and both"""
@@ -464,9 +713,16 @@ class ArtParser:
     @classmethod
     def parse_file(cls, file_stream: TextIO) -> List[AsciiCanvas]:
         """Parse the given file."""
+        return list(cls.iter_file(file_stream))
+
+    @classmethod
+    def iter_file(cls, file_stream: TextIO) -> Iterable[AsciiCanvas]:
+        """Parse the given file, yielding arts as soon as they are parsed."""
         self = cls()
         for line in file_stream:
             self._handle_line(line)
+            yield from self._arts
+            self._arts.clear()
 
         if self._next_height is not None and self._next_height > 0:
             miss = self._next_height
@@ -477,9 +733,394 @@ class ArtParser:
             self._next_width = None
         if self._next_width is not None:
             self._error("Expected one more art after width= definition", None)
-        return self.arts()
+        yield from self._arts
+        self._arts.clear()
+
+
+class ArtLibraryError(Exception):
+    """The file is not a valid art library"""
+
+
+class LibraryArt:
+    """An art from an ArtLibrary, whose lines are read when drawn.
+
+    Its size is known from the library index."""
+    __slots__ = ("_library", "_index", "_width", "_height", "_transparency")
+
+    def __init__(self, library: "ArtLibrary", index: int,
+                 width: int, height: int, transparency: Union[int, None]):
+        self._library = library
+        self._index = index
+        self._width = width
+        self._height = height
+        self._transparency = transparency
+
+    def width(self) -> int:
+        """Return the width of the art"""
+        return self._width
+
+    def height(self) -> int:
+        """Return the height of the art"""
+        return self._height
+
+    def canvas(self) -> AsciiCanvas:
+        """Load the whole art from the library"""
+        return self._library.load(self._index)
+
+    def line(self, y: int, justified: bool = True) -> str:
+        """Return a line of the art, see AsciiCanvas.line()"""
+        line = self._library.line(self._index, y)
+        if justified:
+            return line.ljust(self._width)
+        return line
+
+    def transparency(self) -> Union[int, None]:
+        """See AsciiCanvas.transparency()"""
+        return self._transparency
+
+    def transparency_masks(self) -> Union[List[int], None]:
+        """See AsciiCanvas.transparency_masks()"""
+        if self._transparency is None:
+            return None
+        return self._library.transparency_masks(self._index)
+
+
+class ArtLibrary:
+    """A compiled file of parsed arts, whose lines are read on demand
+
+    The file starts with MAGIC, followed by the lines of each art, encoded
+    in UTF-8.  After that, a table contains the end offset of each line,
+    relative to the start of its art.  Then an index contains the
+    (width, height, offset, line table offset, transparency) of each art,
+    where transparency is -1 for opaque arts.  The file ends with the
+    offset of the index and the number of arts.
+
+    Only the index is read when opening the library.  Lines are read from
+    a memory map of the file, or from the given buffer, each time they are
+    drawn, so arts are not copied in memory.  Only the transparency masks
+    of the most recently drawn transparent arts are kept in a LRU cache."""
+
+    MAGIC = b"\x89AALIB3\n"
+    INDEX_ENTRY = struct.Struct("<IIQQi")
+    LINE_END = struct.Struct("<I")
+    LINE_ENDS = struct.Struct("<II")
+    TRAILER = struct.Struct("<QQ")
+
+    def __init__(self, source: Union[BinaryIO, bytes, memoryview],
+                 cache_size: int = 1024, start: int = 0,
+                 size: Union[int, None] = None):
+        """Open a library from a binary file or a buffer.
+
+        The file may be closed afterward.  The buffer is not copied, so it
+        must not be modified nor released while the library is used.  The
+        library is the size bytes of the buffer at start, or the rest of
+        the buffer if size is None."""
+        self._data: Union[mmap.mmap, bytes, memoryview]
+        if isinstance(source, (bytes, memoryview)):
+            self._data = source
+        else:
+            try:
+                self._data = mmap.mmap(source.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError as err:
+                raise ArtLibraryError("Empty art library") from err
+        self._start = start
+        end = len(self._data) if size is None else start + size
+        if self._data[start:start + len(self.MAGIC)] != self.MAGIC:
+            raise ArtLibraryError("Not an art library")
+        try:
+            trailer_offset = end - self.TRAILER.size
+            index_offset, count = self.TRAILER.unpack_from(self._data,
+                                                           trailer_offset)
+            entries = self.INDEX_ENTRY.iter_unpack(
+                self._data[start + index_offset:trailer_offset])
+            self._index = [entry for entry, _ in zip(entries, range(count))]
+        except struct.error as err:
+            raise ArtLibraryError("Truncated art library") from err
+        if len(self._index) != count:
+            raise ArtLibraryError("Truncated art library")
+        self._arts = [LibraryArt(self, index, width, height,
+                                 None if transparency < 0 else transparency)
+                      for index, (width, height, _, _, transparency)
+                      in enumerate(self._index)]
+        self.transparency_masks = functools.lru_cache(maxsize=cache_size)(
+            self._transparency_masks)
+
+    @classmethod
+    def is_library(cls, file_stream: BinaryIO) -> bool:
+        """Return True if the file starts like an art library.
+
+        The file position is restored afterward."""
+        position = file_stream.tell()
+        magic = file_stream.read(len(cls.MAGIC))
+        file_stream.seek(position)
+        return magic == cls.MAGIC
+
+    def arts(self) -> List[LibraryArt]:
+        """List of arts in this library"""
+        return self._arts
+
+    def line(self, index: int, y: int) -> str:
+        """Read a line of an art, without padding"""
+        _, height, offset, line_ends, _ = self._index[index]
+        if not 0 <= y < height:
+            raise IndexError("Line out of range")
+        line_ends += self._start
+        if y == 0:
+            line_start = 0
+            (line_end,) = self.LINE_END.unpack_from(self._data, line_ends)
+        else:
+            line_start, line_end = self.LINE_ENDS.unpack_from(
+                self._data, line_ends + (y - 1) * self.LINE_END.size)
+        offset += self._start
+        return str(self._data[offset + line_start:offset + line_end],
+                   "utf-8")
+
+    def load(self, index: int) -> AsciiCanvas:
+        """Read a whole art"""
+        width, height, _, _, transparency = self._index[index]
+        art = AsciiCanvas.from_line_list([self.line(index, y)
+                                          for y in range(height)])
+        art.increase_size(width, height)
+        if transparency >= 0:
+            art.make_transparent(transparency)
+        return art
+
+    def _transparency_masks(self, index: int) -> Union[List[int], None]:
+        """Compute the transparency masks of an art"""
+        return self.load(index).transparency_masks()
+
+    @classmethod
+    def write(cls, arts: Iterable[ReadOnlyCanvas],
+              output: BinaryIO) -> int:
+        """Write arts as a library to a binary file
+
+        arts are written as they are iterated, so they do not have to fit
+        in memory.  Return the number of written arts."""
+        index = []
+        line_ends: List[int] = []
+        offset = len(cls.MAGIC)
+        output.write(cls.MAGIC)
+        for art in arts:
+            length = 0
+            transparency = art.transparency()
+            index.append([art.width(), art.height(), offset,
+                          len(line_ends) * cls.LINE_END.size,
+                          -1 if transparency is None else transparency])
+            for y in range(art.height()):
+                data = art.line(y, justified=False).encode("utf-8")
+                output.write(data)
+                length += len(data)
+                line_ends.append(length)
+            offset += length
+        for entry in index:
+            entry[3] += offset
+        for line_end in line_ends:
+            output.write(cls.LINE_END.pack(line_end))
+        offset += len(line_ends) * cls.LINE_END.size
+        for entry in index:
+            output.write(cls.INDEX_ENTRY.pack(*entry))
+        output.write(cls.TRAILER.pack(offset, len(index)))
+        return len(index)
+
+
+# arts that fit in a blank, and their cumulative weights (if not uniform)
+FittableArts = Tuple[List[ReadOnlyCanvas], Union[List[float], None]]
+
+
+class ArtCatalogue:
+    """A collection of ASCII arts from one or more art sets, indexed by size
+
+    Each art set has a weight.  An art set with twice the weight of another
+    will be chosen twice as often, regardless of how many arts each set
+    contains.
+
+    Opaque arts only fit in blanks at least as large as them.  Transparent
+    arts may overlap text with their spaces, so they are tried on blanks at
+    least half their size.
+
+    A catalogue can be copied to shared memory with to_shared_memory(), so
+    that worker processes share its arts with from_shared_memory()."""
+
+    # length of the art library at the start of a shared catalogue
+    SHARED_HEADER = struct.Struct("<Q")
+
+    def __init__(self, arts: Iterable[ReadOnlyCanvas] = ()) -> None:
+        """Create a catalogue, optionally with a first art set"""
+        self._arts: List[ReadOnlyCanvas] = []
+        self._weights: List[float] = []
+        # position in self._arts of each art, indexed by id()
+        self._indices: Dict[int, int] = {}
+        # minimum blank (width, height) to try each art on
+        self._fit_sizes: List[Tuple[int, int]] = []
+        # fittable arts and their cumulative weights, indexed by the
+        # (width, height) of the blank clamped to the largest art size.
+        self._fittable_cache: Dict[Tuple[int, int], FittableArts] = {}
+        self._max_width = 0
+        self._max_height = 0
+        # shared memory holding the arts, see from_shared_memory()
+        self._shared_memory: Union[shared_memory.SharedMemory, None] = None
+        arts = list(arts)
+        if arts:
+            self.add_arts(arts)
+
+    @classmethod
+    def of(cls, arts: "Union[ArtCatalogue, Iterable[ReadOnlyCanvas]]"
+           ) -> "ArtCatalogue":
+        """Return arts as a catalogue, creating one if needed"""
+        if isinstance(arts, ArtCatalogue):
+            return arts
+        return cls(arts)
+
+    def add_arts(self, arts: List[ReadOnlyCanvas],
+                 weight: float = 1.0) -> None:
+        """Add an art set with the given weight"""
+        if weight <= 0:
+            raise ValueError("Art set weight must be positive")
+        if not arts:
+            return
+        for art in arts:
+            self._indices.setdefault(id(art), len(self._arts))
+            self._arts.append(art)
+        self._weights.extend(weight / len(arts) for art in arts)
+        self._fit_sizes.extend(self.fit_size(art) for art in arts)
+        self._max_width = max(self._max_width, *(a.width() for a in arts))
+        self._max_height = max(self._max_height, *(a.height() for a in arts))
+        self._fittable_cache.clear()
+
+    def to_shared_memory(self, name: Union[str, None] = None
+                         ) -> shared_memory.SharedMemory:
+        """Copy the catalogue to a new block of shared memory
+
+        The block contains the length of an art library of all arts, the
+        library itself, then the weight of each art as doubles.  The caller
+        must close() and unlink() the block once workers are done."""
+        library = io.BytesIO()
+        ArtLibrary.write(self._arts, library)
+        weights = struct.pack(f"<{len(self._weights)}d", *self._weights)
+        offset = self.SHARED_HEADER.size
+        size = offset + library.tell() + len(weights)
+        shared = shared_memory.SharedMemory(name, create=True, size=size)
+        buf = shared.buf
+        assert buf is not None
+        self.SHARED_HEADER.pack_into(buf, 0, library.tell())
+        for data in (library.getvalue(), weights):
+            buf[offset:offset + len(data)] = data
+            offset += len(data)
+        return shared
+
+    @classmethod
+    def from_shared_memory(cls, name: str,
+                           cache_size: int = 1024) -> "ArtCatalogue":
+        """Attach to a catalogue copied by to_shared_memory()
+
+        Lines of arts are read from the shared memory when drawn, without
+        copying the block.  Only the transparency masks of the cache_size
+        most recently drawn transparent arts are kept in this process, see
+        ArtLibrary.  The block stays attached
+        until close() is called, and is never unlinked by this process."""
+        if sys.version_info >= (3, 13):
+            shared = shared_memory.SharedMemory(name, track=False)
+        else:
+            # Processes forked or spawned by the creator share its resource
+            # tracker, which must keep the block registered.  Others start
+            # their own, which would unlink the block when they exit.
+            inherited = getattr(resource_tracker._resource_tracker, "_fd",
+                                None) is not None
+            shared = shared_memory.SharedMemory(name)
+            if not inherited:
+                resource_tracker.unregister(shared._name,  # type: ignore
+                                            "shared_memory")
+        buf = shared.buf
+        assert buf is not None
+        try:
+            (length,) = cls.SHARED_HEADER.unpack_from(buf)
+            start = cls.SHARED_HEADER.size
+            library = ArtLibrary(buf, cache_size, start, length)
+            arts = library.arts()
+            weights = struct.unpack_from(f"<{len(arts)}d", buf,
+                                         start + length)
+        except (struct.error, ArtLibraryError) as err:
+            shared.close()
+            raise ArtLibraryError("Invalid shared art catalogue") from err
+        catalogue = cls()
+        for art, weight in zip(arts, weights):
+            catalogue.add_arts([art], weight)
+        catalogue._shared_memory = shared
+        return catalogue
+
+    def close(self) -> None:
+        """Detach from the shared memory of from_shared_memory()
+
+        The catalogue is empty afterward.  This does nothing for other
+        catalogues."""
+        if self._shared_memory is None:
+            return
+        self._arts.clear()
+        self._weights.clear()
+        self._indices.clear()
+        self._fit_sizes.clear()
+        self._fittable_cache.clear()
+        self._max_width = 0
+        self._max_height = 0
+        self._shared_memory.close()
+        self._shared_memory = None
+
+    def arts(self) -> List[ReadOnlyCanvas]:
+        """List of all arts in the catalogue"""
+        return self._arts
+
+    def __len__(self) -> int:
+        return len(self._arts)
+
+    def index(self, art: ReadOnlyCanvas) -> int:
+        """Return the position of an art in arts()"""
+        return self._indices[id(art)]
+
+    @staticmethod
+    def fit_size(art: ReadOnlyCanvas) -> Tuple[int, int]:
+        """Return the minimum size of a blank to try this art on"""
+        if art.transparency() is None:
+            return (art.width(), art.height())
+        return ((art.width() + 1) // 2, (art.height() + 1) // 2)
+
+    def min_width(self) -> int:
+        """Return the minimum width of a blank to try an art on"""
+        return min(width for width, _ in self._fit_sizes)
+
+    def max_height(self) -> int:
+        """Return the height of the tallest art"""
+        return self._max_height
+
+    def fittable_arts(self, width: int, height: int) -> FittableArts:
+        """Return arts that fit in a blank of the given size
+
+        Return (arts, cumulative_weights), where cumulative_weights is None
+        if all arts are equally likely to be chosen."""
+        key = (min(width, self._max_width), min(height, self._max_height))
+        cached = self._fittable_cache.get(key)
+        if cached is not None:
+            return cached
+        fittable = [(art, weight) for art, weight, (width, height)
+                    in zip(self._arts, self._weights, self._fit_sizes)
+                    if width <= key[0] and height <= key[1]]
+        arts = [art for art, _ in fittable]
+        cum_weights: Union[List[float], None] = None
+        if len({weight for _, weight in fittable}) > 1:
+            cum_weights = list(itertools.accumulate(w for _, w in fittable))
+        self._fittable_cache[key] = (arts, cum_weights)
+        return arts, cum_weights
+
+    @staticmethod
+    def choose(fittable: FittableArts,
+               rand: RandomSource) -> ReadOnlyCanvas:
+        """Randomly choose an art returned by fittable_arts()"""
+        arts, cum_weights = fittable
+        if cum_weights is None:
+            return rand.choice(arts)
+        return rand.choices(arts, cum_weights=cum_weights)[0]
+
 
-Iterated = TypeVar("Iterated")
 def drain_if(a_list: List[Iterated]
             ) -> Iterable[Tuple[Iterated, Callable[[], None]]]:
     """Iterate a list while removing some of its elements
@@ -506,6 +1147,98 @@ def drain_if(a_list: List[Iterated]
             index += 1
 
 
+class PlacementTraceError(Exception):
+    """Error raised when a placement trace is invalid"""
+
+
+class PlacementObserver(Protocol):
+    """What BlankFinder and sprinkle_art() report while sprinkling art
+
+    Rects and line numbers are those of the BlankFinder.  See
+    PlacementTrace."""
+    def blank(self, rect: Rect) -> None:
+        """Called for each drained blank"""
+
+    def attempt(self, rect: Rect, art: int, placed: bool) -> None:
+        """Called for each attempt to sprinkle the art at position 'art' of
+        the catalogue"""
+
+    def flush(self, line: int) -> None:
+        """Called when all lines before this one were written"""
+
+    def finish(self) -> None:
+        """Called at the end of the input"""
+
+
+class PlacementTrace:
+    """Record what BlankFinder and sprinkle_art() do, as JSON lines
+
+    Each line is a JSON array starting with the kind of event:
+    - ["blank", x_start, x_end, y_start, y_end]: a blank was drained.
+    - ["place", x_start, x_end, y_start, y_end, art]: the art at position
+      'art' of the catalogue was sprinkled at this rect.
+    - ["miss", x_start, x_end, y_start, y_end, art]: the same, but the
+      art did not fit.
+    - ["flush", line]: all lines before this one were written.
+
+    Lines are numbered from 1.  See replay_placements()."""
+
+    # length of each kind of event
+    LENGTHS = {"blank": 5, "place": 6, "miss": 6, "flush": 2}
+
+    def __init__(self, output: TextIO):
+        self._output = output
+        # consecutive flushes are merged into the last one
+        self._pending_flush: Union[int, None] = None
+
+    def _event(self, *event: Any) -> None:
+        self.finish()
+        self._output.write(json.dumps(event, separators=(",", ":")))
+        self._output.write("\n")
+
+    def blank(self, rect: Rect) -> None:
+        """Record a drained blank"""
+        self._event("blank", rect.x_start, rect.x_end, rect.y_start,
+                    rect.y_end)
+
+    def attempt(self, rect: Rect, art: int, placed: bool) -> None:
+        """Record an attempt to sprinkle an art"""
+        self._event("place" if placed else "miss", rect.x_start,
+                    rect.x_end, rect.y_start, rect.y_end, art)
+
+    def flush(self, line: int) -> None:
+        """Record that lines before this line number were written"""
+        self._pending_flush = line
+
+    def finish(self) -> None:
+        """Write the last recorded flush, if it is not written yet"""
+        if self._pending_flush is not None:
+            self._output.write(f'["flush",{self._pending_flush}]\n')
+            self._pending_flush = None
+
+    @classmethod
+    def read(cls, trace_stream: Iterable[str],
+             kinds: Sequence[str] = tuple(LENGTHS)) -> Iterable[List[Any]]:
+        """Parse a trace, yielding its events of the given kinds as lists
+
+        Events of other kinds are skipped without being parsed."""
+        skipped = tuple(f'["{kind}",' for kind in cls.LENGTHS
+                        if kind not in kinds)
+        for lineno, line in enumerate(trace_stream, 1):
+            if line.startswith(skipped):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError as err:
+                raise PlacementTraceError(f"line {lineno}: {err}") from err
+            if (not isinstance(event, list) or not event
+                    or cls.LENGTHS.get(event[0]) != len(event)
+                    or not all(isinstance(value, int)
+                               for value in event[1:])):
+                raise PlacementTraceError(f"line {lineno}: invalid event")
+            yield event
+
+
 class BlankFinder:
     """Find whitespace in a stream and provide a way to fill them
 
@@ -523,7 +1256,9 @@ class BlankFinder:
     def __init__(self,
                  soft_max_width: int,
                  minimum_blank_width: int,
-                 maximum_blank_height: int):
+                 maximum_blank_height: int,
+                 passthrough: Union["re.Pattern[str]", None] = None,
+                 trace: Union[PlacementObserver, None] = None):
         """Create a new BlankFinder.
 
         soft_max_width controls the length of lines that the output supports.
@@ -536,17 +1271,31 @@ class BlankFinder:
 
         maximum_blank_height controls the maximum blank height to find.
         If a larger blank is found, it will be truncated.  This also controls
-        the maximum height of the buffer"""
+        the maximum height of the buffer
+
+        passthrough matches lines which must be left untouched, see
+        can_skip_line()
+
+        If trace is given, drained blanks and flushed lines are recorded
+        in it."""
         # Blanks from the previous line, sorted by x_start
         # It is unknown whether they can be continued or not.
         self._current_blanks : List[Rect] = []
-        # Blanks that cannot be made larger.
-        self._max_blanks : List[Rect] = []
+        # Blanks that cannot be made larger, indexed by insertion order.
+        self._max_blanks : Dict[int, Rect] = {}
+        # Heaps of (y_end, id) and (y_start, id) of self._max_blanks.
+        # The y_start heap is lazily cleaned of drained blanks.
+        self._max_blanks_by_end : List[Tuple[int, int]] = []
+        self._max_blanks_by_start : List[Tuple[int, int]] = []
+        self._next_max_blank_id = 0
         self._canvas = AsciiCanvas(soft_max_width, 0)
         self._current_line_no = 0
-        self._soft_max_width = 80
+        self._soft_max_width = soft_max_width
         self._minimum_blank_width = minimum_blank_width
+        self._minimum_blank = " " * minimum_blank_width
         self._maximum_blank_height = maximum_blank_height
+        self._passthrough = passthrough
+        self._trace = trace
 
     blank_re = re.compile(" +")
 
@@ -567,6 +1316,26 @@ class BlankFinder:
         if len(line) + self._minimum_blank_width <= self._soft_max_width:
             yield (len(line), self._soft_max_width)
 
+    def _add_max_blank(self, rect: Rect) -> None:
+        """Add a rectangle to the blanks that cannot be made larger"""
+        blank_id = self._next_max_blank_id
+        self._next_max_blank_id += 1
+        self._max_blanks[blank_id] = rect
+        heapq.heappush(self._max_blanks_by_end, (rect.y_end, blank_id))
+        heapq.heappush(self._max_blanks_by_start, (rect.y_start, blank_id))
+
+    def _first_line_of_max_blanks(self, default: int) -> int:
+        """Return the first line number occupied by a blank that cannot be
+        made larger.
+
+        If there is none, then return "default"."""
+        by_start = self._max_blanks_by_start
+        while by_start and by_start[0][1] not in self._max_blanks:
+            heapq.heappop(by_start)
+        if not by_start:
+            return default
+        return by_start[0][0]
+
     @staticmethod
     def _add_rect_to_dict(dict_of_pair_to_rect: Dict[Tuple[int, int], Rect],
                           rect: Rect) -> None:
@@ -626,7 +1395,7 @@ class BlankFinder:
                 # **     ****   ***
                 #    **    ****  **
                 delete_last()
-                self._max_blanks.append(last)
+                self._add_max_blank(last)
 
     def add_line(self, line: str) -> None:
         """Add a line to the canvas to search for blanks
@@ -644,24 +1413,56 @@ class BlankFinder:
             self._handle_blank_in_current_line(x_start, x_end, last_blanks,
                                                blanks)
 
-        self._max_blanks.extend(last_blanks)
+        for blank in last_blanks:
+            self._add_max_blank(blank)
         self._current_blanks.clear()
         for blank in blanks.values():
             if blank.height() >= self._maximum_blank_height:
-                self._max_blanks.append(blank.clone())
+                self._add_max_blank(blank.clone())
                 blank.resize_y(self._maximum_blank_height - 1, True)
             self._current_blanks.append(blank)
         self._current_blanks.sort(key=lambda r: r.x_start)
 
+    def can_skip_line(self, line: str) -> bool:
+        """Return True if no art can be sprinkled on this line
+
+        This is the case for lines matching the passthrough pattern, and for
+        lines which have no blank of minimum_blank_width, which is checked
+        without looking for every blank.
+
+        Blanks cannot extend through these lines.  Once blanks above them
+        have been filled, they can be skipped with skip_line()."""
+        if (len(line) + self._minimum_blank_width > self._soft_max_width
+                and line.find(self._minimum_blank, 0,
+                              self._soft_max_width) == -1):
+            return True
+        return (self._passthrough is not None
+                and self._passthrough.search(line) is not None)
+
+    def skip_line(self) -> bool:
+        """Skip a line which is written to the output directly.
+
+        This is only possible if the canvas is empty and no blanks are
+        pending, e.g. after end_of_file() and flushing the canvas.  Return
+        False if this is not the case, in which case nothing is done."""
+        if self._canvas.height() or self._current_blanks or self._max_blanks:
+            return False
+        self._current_line_no += 1
+        if self._trace is not None:
+            self._trace.flush(self._current_line_no + 1)
+        return True
+
     def end_of_file(self) -> None:
         """Indicate that the end of the file/stream was reached.
 
         This indicates that blanks that extends up to the current line cannot
-        be extended further."""
-        self._max_blanks.extend(self._current_blanks)
+        be extended further.  Lines can still be added afterward, blanks
+        will then start again from scratch."""
+        for blank in self._current_blanks:
+            self._add_max_blank(blank)
         self._current_blanks.clear()
 
-    def try_fill_blank(self, rect: Rect, art: AsciiCanvas) -> bool:
+    def try_fill_blank(self, rect: Rect, art: ReadOnlyCanvas) -> bool:
         """Try to fill a blank with an art.
 
         Return False if the rect is not empty (e.g. it has been filled through
@@ -671,7 +1472,11 @@ class BlankFinder:
         assert rect.width() == art.width() and rect.height() == art.height()
         rect = rect.clone()
         rect.shift_y(self._canvas.height() - 1 - self._current_line_no)
-        if not self._canvas.is_rectangle_free(rect):
+        masks = art.transparency_masks()
+        if masks is None:
+            if not self._canvas.is_rectangle_free(rect):
+                return False
+        elif not self._canvas.is_rectangle_free_under(rect, masks):
             return False
         self._canvas.blit(art, rect.x_start, rect.y_start)
         return True
@@ -699,17 +1504,24 @@ class BlankFinder:
             return
 
         assert canvas_start <= min_line
-        for blank, delete_blank in drain_if(self._max_blanks):
-            if blank.y_end <= min_line:
-                delete_blank()
-                yield blank
+        by_end = self._max_blanks_by_end
+        drained = []
+        while by_end and by_end[0][0] <= min_line:
+            drained.append(heapq.heappop(by_end)[1])
+        # yield in insertion order, so that the output does not depend on
+        # how the heap breaks ties.
+        drained.sort()
+        blanks = [self._max_blanks.pop(blank_id) for blank_id in drained]
+        if self._trace is not None:
+            for blank in blanks:
+                self._trace.blank(blank)
+        yield from blanks
 
     def flush_canvas(self, output: TextIO) -> None:
         """Drain lines which are not covered by blanks to the given output
         """
         next_line = self._current_line_no + 1
-        min_largest_line = self.get_first_line_of_rects(self._max_blanks,
-                                                        next_line)
+        min_largest_line = self._first_line_of_max_blanks(next_line)
         min_current_line = self.get_first_line_of_rects(self._current_blanks,
                                                         next_line)
         min_line = min(min_largest_line, min_current_line)
@@ -718,62 +1530,861 @@ class BlankFinder:
             return
         flushable = self._canvas.remove_lines_at_top(min_line - canvas_start)
         flushable.write(output)
+        if self._trace is not None:
+            self._trace.flush(min_line)
+
+
+class PlacementQuota:
+    """Limit how much art is sprinkled, using running counters
+
+    density is the maximum fraction of the blank area (white space and
+    space after the end of lines, up to soft_max_width) that art may cover.
+
+    max_arts_per_kline is the maximum number of arts per 1000 lines.
+
+    Both limits are checked against the lines read so far, so art stays
+    evenly spread over infinite streams.
+
+    time_budget_ms is the time after which no more art is sprinkled,
+    counted from the creation of the quota."""
+
+    def __init__(self, soft_max_width: int,
+                 density: Union[float, None] = None,
+                 max_arts_per_kline: Union[float, None] = None,
+                 time_budget_ms: Union[float, None] = None):
+        if density is not None and not 0 <= density <= 1:
+            raise ValueError("density must be between 0 and 1")
+        if max_arts_per_kline is not None and max_arts_per_kline < 0:
+            raise ValueError("max_arts_per_kline must not be negative")
+        if time_budget_ms is not None and time_budget_ms < 0:
+            raise ValueError("time_budget_ms must not be negative")
+        self._soft_max_width = soft_max_width
+        self._density = density
+        self._max_arts_per_kline = max_arts_per_kline
+        self._deadline: Union[float, None] = None
+        if time_budget_ms is not None:
+            self._deadline = time.monotonic() + time_budget_ms / 1000
+        self._lines = 0
+        self._blank_area = 0
+        self._arts = 0
+        self._art_area = 0
 
-
-def sprinkle_art(blank_finder: BlankFinder, arts: List[AsciiCanvas],
-                 rand: random.Random) -> None:
+    def add_line(self, line: str) -> None:
+        """Account for a line of input"""
+        self._lines += 1
+        if self._density is not None:
+            visible = line[:self._soft_max_width]
+            self._blank_area += (visible.count(" ")
+                                 + self._soft_max_width - len(visible))
+
+    def art_placed(self, art: ReadOnlyCanvas) -> None:
+        """Account for an art that was sprinkled"""
+        self._arts += 1
+        self._art_area += art.width() * art.height()
+
+    def out_of_time(self) -> bool:
+        """Return True if the time budget is exhausted.
+
+        Unlike other limits, this one is final."""
+        if self._deadline is None:
+            return False
+        return time.monotonic() >= self._deadline
+
+    def exhausted(self) -> bool:
+        """Return True if no more art should be sprinkled for now"""
+        if (self._density is not None
+                and self._art_area >= self._density * self._blank_area):
+            return True
+        if (self._max_arts_per_kline is not None
+                and self._arts * 1000 >= self._max_arts_per_kline
+                * self._lines):
+            return True
+        return self.out_of_time()
+
+
+def sprinkle_art(blank_finder: BlankFinder,
+                 arts: Union[ArtCatalogue, List[ReadOnlyCanvas]],
+                 rand: Union[random.Random, KeyedRandom],
+                 quota: Union[PlacementQuota, None] = None,
+                 trace: Union[PlacementObserver, None] = None) -> None:
     """Randomly sprinkle art from 'arts' to blanks found by BlankFinder
 
-    rand is the random generator to use.
+    rand is the random generator to use.  If it is a KeyedRandom, the
+    art and position tried for a blank only depend on the blank and the
+    attempt number.  arts should preferably be an ArtCatalogue, as it
+    caches which arts fit in which blank sizes.
+
+    If quota is given, stop sprinkling as soon as it is exhausted.  Blanks
+    are still drained from the BlankFinder.  Larger blanks are filled
+    first, so they are the ones filled if the quota runs out.
+
+    If trace is given, each attempt is recorded in it.
 
     The art is mostly randomly sprinkled using a Monte-Carlo-like approach,
     where possibly overlapping blanks found by BlankFinder are sprinkled with
     random art as long as it fits, until a maximum amount of tries is reached.
     """
+    catalogue = ArtCatalogue.of(arts)
     fillable = list(blank_finder.drain_fillable_blanks())
     fillable.sort(key=lambda rect: -rect.width() * rect.height())
 
     for maybe_blank in fillable:
-        fittable_arts = [art for art in arts
-                         if (art.width() <= maybe_blank.width() and
-                             art.height() <= maybe_blank.height())]
-        if not fittable_arts:
+        if quota is not None and quota.exhausted():
+            return
+        fittable_arts = catalogue.fittable_arts(maybe_blank.width(),
+                                                maybe_blank.height())
+        if not fittable_arts[0]:
             continue
         max_tries = 5
-        for _ in range(max_tries):
-            art = rand.choice(fittable_arts)
+        for attempt in range(max_tries):
+            attempt_rand: RandomSource
+            if isinstance(rand, KeyedRandom):
+                attempt_rand = rand.stream(
+                        maybe_blank.x_start, maybe_blank.x_end,
+                        maybe_blank.y_start, maybe_blank.y_end, attempt)
+            else:
+                attempt_rand = rand
+            art = catalogue.choose(fittable_arts, attempt_rand)
             rect = random_subrectangle(maybe_blank, art.width(),
-                                       art.height(), rand)
-            blank_finder.try_fill_blank(rect, art)
+                                       art.height(), attempt_rand)
+            placed = blank_finder.try_fill_blank(rect, art)
+            if trace is not None:
+                trace.attempt(rect, catalogue.index(art), placed)
+            if placed and quota is not None:
+                quota.art_placed(art)
+                if quota.exhausted():
+                    return
 
 
-def sprinkle_art_on_stream(input_stream: TextIO, output_stream: TextIO,
-                           arts: List[AsciiCanvas],
-                           rand: random.Random,
-                           soft_max_width: int = 80) -> None:
-    """Read the input stream, sprinkle arts and write to the output stream
+@dataclass
+class StageStats:
+    """Statistics of a stage of the art sprinkling pipeline"""
+    seconds: float = 0.0
+    items: int = 0
+
+    def add(self, seconds: float, items: int = 1) -> None:
+        """Account for some work done by this stage"""
+        self.seconds += seconds
+        self.items += items
+
+
+@dataclass
+class QueueStats:
+    """Statistics of a queue between two pipeline stages"""
+    max_depth: int = 0
+    total_depth: int = 0
+    samples: int = 0
 
-    soft_max_width controls the expected """
-    min_width = min(arts, key=lambda art: art.width()).width()
-    max_height = max(arts, key=lambda art: art.height()).height()
+    def sample(self, depth: int) -> None:
+        """Account for the depth of the queue when an item is added"""
+        self.max_depth = max(self.max_depth, depth)
+        self.total_depth += depth
+        self.samples += 1
 
-    finder = BlankFinder(soft_max_width, min_width, max_height * 5)
+    def mean_depth(self) -> float:
+        """Return the average depth of the queue"""
+        return self.total_depth / self.samples if self.samples else 0.0
 
-    for lineno, line in enumerate(input_stream):
-        finder.add_line(line.rstrip("\n").expandtabs())
+
+@dataclass
+class PipelineStats:
+    """Time spent in each stage of the art sprinkling pipeline
+
+    'read' and 'write' only exist in pipelined mode, see
+    sprinkle_art_on_stream_pipelined().  'find' is the time spent
+    searching for blanks, or copying lines without room for art to the
+    output.  'place' is the time spent sprinkling art and flushing lines.
+    Time spent waiting on other stages is not counted."""
+    read: StageStats = field(default_factory=StageStats)
+    find: StageStats = field(default_factory=StageStats)
+    place: StageStats = field(default_factory=StageStats)
+    write: StageStats = field(default_factory=StageStats)
+    input_queue: QueueStats = field(default_factory=QueueStats)
+    output_queue: QueueStats = field(default_factory=QueueStats)
+
+    def report(self) -> str:
+        """Return a human-readable report"""
+        lines = ["stage   seconds     items"]
+        for name in ("read", "find", "place", "write"):
+            stage = getattr(self, name)
+            lines.append(f"{name:6} {stage.seconds:8.3f} {stage.items:9}")
+        for name in ("input_queue", "output_queue"):
+            queue_stats = getattr(self, name)
+            lines.append(f"{name}: max depth {queue_stats.max_depth}, "
+                         f"mean depth {queue_stats.mean_depth():.1f}")
+        return "\n".join(lines)
+
+
+def sprinkle_art_on_stream(input_stream: Iterable[str], output_stream: TextIO,
+                           arts: Union[ArtCatalogue, List[ReadOnlyCanvas]],
+                           rand: Union[random.Random, KeyedRandom],
+                           soft_max_width: int = 80,
+                           density: Union[float, None] = None,
+                           max_arts_per_kline: Union[float, None] = None,
+                           stats: Union[PipelineStats, None] = None,
+                           time_budget_ms: Union[float, None] = None,
+                           passthrough: Iterable[str] = (),
+                           trace: Union[PlacementObserver, None] = None,
+                           minimum_blank_width: Union[int, None] = None,
+                           maximum_blank_height: Union[int, None] = None
+                           ) -> None:
+    """Read the input stream, sprinkle arts and write to the output stream
+
+    soft_max_width controls the expected width of the text.
+
+    minimum_blank_width and maximum_blank_height are passed to BlankFinder.
+    They default to the width of the narrowest art and five times the
+    height of the tallest art.  See auto_tune() to choose them.
+
+    density and max_arts_per_kline limit the amount of sprinkled art,
+    see PlacementQuota.
+
+    If time_budget_ms is given, no art is sprinkled after this many
+    milliseconds.  The rest of the input is then copied to the output
+    without searching for blanks.
+
+    Lines matching one of the passthrough regular expressions, as well as
+    lines without room for any art, are copied to the output directly.
+
+    If stats is given, the time spent finding blanks and placing art is
+    added to it.
+
+    If trace is given, blanks and placements are recorded in it, so they
+    can be replayed with replay_placements()."""
+    arts = ArtCatalogue.of(arts)
+    min_width = arts.min_width()
+    max_height = arts.max_height()
+    if minimum_blank_width is not None:
+        min_width = max(min_width, minimum_blank_width)
+    if maximum_blank_height is None:
+        maximum_blank_height = max_height * 5
+    elif maximum_blank_height < max(max_height, 2):
+        raise ValueError("maximum_blank_height must be at least 2 and the "
+                         "height of the tallest art")
+
+    passthrough_re = None
+    if passthrough:
+        passthrough_re = re.compile("|".join(f"(?:{pattern})"
+                                             for pattern in passthrough))
+    finder = BlankFinder(soft_max_width, min_width, maximum_blank_height,
+                         passthrough_re, trace)
+    quota = None
+    if (density is not None or max_arts_per_kline is not None
+            or time_budget_ms is not None):
+        quota = PlacementQuota(soft_max_width, density, max_arts_per_kline,
+                               time_budget_ms)
+
+    start = 0.0
+    out_of_time = False
+    lines = iter(input_stream)
+    for lineno, line in enumerate(lines):
+        if stats is not None:
+            start = time.perf_counter()
+        line = line.rstrip("\n").expandtabs()
+        if quota is not None:
+            quota.add_line(line)
+        if finder.can_skip_line(line):
+            if not finder.skip_line():
+                if stats is not None:
+                    found = time.perf_counter()
+                    stats.find.add(found - start, 0)
+                    start = found
+                finder.end_of_file()
+                sprinkle_art(finder, arts, rand, quota, trace)
+                finder.flush_canvas(output_stream)
+                skipped = finder.skip_line()
+                assert skipped
+                if stats is not None:
+                    placed = time.perf_counter()
+                    stats.place.add(placed - start)
+                    start = placed
+            print(line.rstrip(), file=output_stream)
+            if stats is not None:
+                stats.find.add(time.perf_counter() - start)
+            continue
+        finder.add_line(line)
+        if stats is not None:
+            found = time.perf_counter()
+            stats.find.add(found - start)
+            start = found
         if lineno % max_height == 0:
-            sprinkle_art(finder, arts, rand)
+            sprinkle_art(finder, arts, rand, quota, trace)
             finder.flush_canvas(output_stream)
+            if stats is not None:
+                stats.place.add(time.perf_counter() - start)
+            if quota is not None and quota.out_of_time():
+                out_of_time = True
+                break
 
+    if stats is not None:
+        start = time.perf_counter()
     finder.end_of_file()
-    sprinkle_art(finder, arts, rand)
+    sprinkle_art(finder, arts, rand, quota, trace)
     finder.flush_canvas(output_stream)
+    if trace is not None:
+        trace.finish()
+    if stats is not None:
+        stats.place.add(time.perf_counter() - start)
+
+    if out_of_time:
+        if stats is not None:
+            start = time.perf_counter()
+        copied = 0
+        for line in lines:
+            print(line.rstrip("\n").expandtabs().rstrip(), file=output_stream)
+            copied += 1
+        if stats is not None:
+            stats.find.add(time.perf_counter() - start, copied)
+
+
+class _QueueWriter:
+    """A minimal text file-like object which sends text to a queue
+
+    Text is sent in chunks of at least chunk_size characters, or when
+    flush() is called.  Once the consumer of the queue adds an exception to
+    errors, flush() raises it."""
+    def __init__(self, output_queue: "queue.Queue[Union[str, None]]",
+                 queue_stats: QueueStats, chunk_size: int,
+                 errors: List[BaseException]):
+        self._queue = output_queue
+        self._queue_stats = queue_stats
+        self._errors = errors
+        self._chunk_size = chunk_size
+        self._chunks: List[str] = []
+        self._size = 0
+
+    def write(self, text: str) -> int:
+        """Buffer text, sending it to the queue if the buffer is full"""
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self._chunk_size:
+            self.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        """Send buffered text to the queue"""
+        if self._errors:
+            raise self._errors[0]
+        if self._chunks:
+            self._queue_stats.sample(self._queue.qsize())
+            self._queue.put("".join(self._chunks))
+            self._chunks.clear()
+            self._size = 0
+
+
+def sprinkle_art_on_stream_pipelined(input_stream: Iterable[str],
+                                     output_stream: TextIO,
+                                     arts: Union[ArtCatalogue,
+                                                 List[ReadOnlyCanvas]],
+                                     rand: Union[random.Random,
+                                                 KeyedRandom],
+                                     *,
+                                     stats: Union[PipelineStats, None] = None,
+                                     queue_size: int = 16,
+                                     batch_size: int = 256,
+                                     **kwargs: Any) -> PipelineStats:
+    """Like sprinkle_art_on_stream(), but read and write in other threads
+
+    Input lines are read by a thread in batches of batch_size lines, and
+    written by another thread in chunks of text.  Both threads are
+    connected to the sprinkling thread by queues holding at most
+    queue_size batches or chunks, so a slow reader or writer blocks the
+    others instead of buffering unbounded amounts of text.
+
+    Finding blanks and placing art both modify the same canvas, so they
+    stay in the calling thread.
+
+    Return the statistics of each stage, which are also added to stats if
+    given.  Other keyword arguments are passed to
+    sprinkle_art_on_stream()."""
+    if stats is None:
+        stats = PipelineStats()
+    input_queue: "queue.Queue[Union[List[str], BaseException, None]]"
+    input_queue = queue.Queue(queue_size)
+    output_queue: "queue.Queue[Union[str, None]]" = queue.Queue(queue_size)
+    write_errors: List[BaseException] = []
+    # set when sprinkling ended, so the reader stops even if it failed
+    stop_reading = threading.Event()
+
+    def read() -> None:
+        lines = iter(input_stream)
+        try:
+            while not stop_reading.is_set():
+                start = time.perf_counter()
+                batch = list(itertools.islice(lines, batch_size))
+                stats.read.add(time.perf_counter() - start, len(batch))
+                if not batch:
+                    input_queue.put(None)
+                    return
+                stats.input_queue.sample(input_queue.qsize())
+                input_queue.put(batch)
+        except BaseException as err:
+            input_queue.put(err)
+
+    def write() -> None:
+        while (chunk := output_queue.get()) is not None:
+            if write_errors:
+                continue
+            start = time.perf_counter()
+            try:
+                output_stream.write(chunk)
+            except BaseException as err:
+                # keep draining the queue so the sprinkler does not block
+                write_errors.append(err)
+            stats.write.add(time.perf_counter() - start)
+        if not write_errors:
+            try:
+                output_stream.flush()
+            except BaseException as err:
+                write_errors.append(err)
+
+    def read_lines() -> Iterable[str]:
+        while (batch := input_queue.get()) is not None:
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+
+    reader = threading.Thread(target=read, name="sprinkler-reader",
+                              daemon=True)
+    writer = threading.Thread(target=write, name="sprinkler-writer",
+                              daemon=True)
+    reader.start()
+    writer.start()
+    queue_writer = _QueueWriter(output_queue, stats.output_queue,
+                                chunk_size=64 * 1024, errors=write_errors)
+    try:
+        sprinkle_art_on_stream(read_lines(), cast(TextIO, queue_writer),
+                               arts, rand, stats=stats, **kwargs)
+        queue_writer.flush()
+    finally:
+        output_queue.put(None)
+        writer.join()
+        # unblock the reader, which puts at most one more batch
+        stop_reading.set()
+        with contextlib.suppress(queue.Empty):
+            while True:
+                input_queue.get_nowait()
+        reader.join()
+    if write_errors:
+        raise write_errors[0]
+    return stats
+
+
+class _WorkCounter:
+    """A PlacementObserver which only counts events"""
+    def __init__(self) -> None:
+        self.blanks = 0
+        self.attempts = 0
+        self.placed = 0
+
+    def blank(self, rect: Rect) -> None:
+        self.blanks += 1
+
+    def attempt(self, rect: Rect, art: int, placed: bool) -> None:
+        self.attempts += 1
+        self.placed += placed
+
+    def flush(self, line: int) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+@dataclass
+class TunedSettings:
+    """Settings of sprinkle_art_on_stream() chosen by auto_tune()"""
+    soft_max_width: int = 80
+    minimum_blank_width: Union[int, None] = None
+    maximum_blank_height: Union[int, None] = None
+
+
+def auto_tune(sample: List[str],
+              arts: Union[ArtCatalogue, List[ReadOnlyCanvas]],
+              passthrough: Iterable[str] = ()) -> TunedSettings:
+    """Choose settings for sprinkling text similar to the sample lines
+
+    Candidate soft max widths are taken from the line lengths of the
+    sample, and candidate minimum blank widths from the art widths.  They
+    are tried on the sample, one setting after the other, to maximize the
+    number of arts placed per unit of work.  Work is the number of lines,
+    blanks and attempts, which follows the CPU time but does not depend on
+    the machine, so the same sample always gives the same settings."""
+    catalogue = ArtCatalogue.of(arts)
+    passthrough = list(passthrough)
+    lengths = sorted(len(line.rstrip("\n").expandtabs().rstrip())
+                     for line in sample)
+    if not lengths:
+        return TunedSettings()
+    max_height = catalogue.max_height()
+    settings = TunedSettings(80, catalogue.min_width(), max_height * 5)
+
+    def efficiency(candidate: TunedSettings) -> float:
+        counter = _WorkCounter()
+        sprinkle_art_on_stream(
+                sample, io.StringIO(), catalogue, random.Random(0),
+                candidate.soft_max_width, passthrough=passthrough,
+                trace=counter,
+                minimum_blank_width=candidate.minimum_blank_width,
+                maximum_blank_height=candidate.maximum_blank_height)
+        return counter.placed / (len(sample) + counter.blanks
+                                 + counter.attempts)
+
+    def tune(name: str, values: Iterable[int]) -> None:
+        candidates = [replace(settings, **{name: value})
+                      for value in sorted(set(values))]
+        best = max(candidates, key=efficiency)
+        setattr(settings, name, getattr(best, name))
+
+    length = lengths[len(lengths) * 95 // 100]
+    widest = max(art.width() for art in catalogue.arts())
+    tune("soft_max_width", [max(length, 1), length + widest])
+    fit_widths = sorted(catalogue.fit_size(art)[0]
+                        for art in catalogue.arts())
+    tune("minimum_blank_width", [fit_widths[(len(fit_widths) - 1)
+                                            * quartile // 4]
+                                 for quartile in range(5)])
+    tune("maximum_blank_height", [max_height * factor
+                                  for factor in (2, 5, 10)])
+    return settings
+
+
+def replay_placements(input_stream: Iterable[str], output_stream: TextIO,
+                      arts: Union[ArtCatalogue, List[ReadOnlyCanvas]],
+                      trace_stream: Iterable[str]) -> None:
+    """Sprinkle arts where a PlacementTrace says they were sprinkled
+
+    Neither blanks nor randomness are needed, so this is faster than
+    sprinkle_art_on_stream().  With the input and arts of the traced run,
+    the output is the same."""
+    art_list = ArtCatalogue.of(arts).arts()
+    canvas = AsciiCanvas(0, 0)
+    # line number of the top of the canvas
+    canvas_start = 1
+    lines = iter(input_stream)
+
+    def read_until(line_no: int) -> None:
+        while canvas_start + canvas.height() <= line_no:
+            line = next(lines, None)
+            if line is None:
+                raise PlacementTraceError(
+                        f"line {line_no} is after the end of the input")
+            canvas.add_line(line.rstrip("\n").expandtabs(), True)
+
+    for event in PlacementTrace.read(trace_stream, ("place", "flush")):
+        if event[0] == "place":
+            x_start, x_end, y_start, y_end, index = event[1:6]
+            if not 0 <= index < len(art_list):
+                raise PlacementTraceError(f"no art at position {index}")
+            if y_start < canvas_start:
+                raise PlacementTraceError(
+                        f"line {y_start} was already written")
+            read_until(y_end - 1)
+            if x_end > canvas.width():
+                canvas.increase_size(x_end, canvas.height())
+            try:
+                canvas.blit(art_list[index], x_start, y_start - canvas_start)
+            except IndexError as err:
+                raise PlacementTraceError(
+                        f"invalid position {x_start}, {y_start}") from err
+        elif event[1] > canvas_start:
+            read_until(event[1] - 1)
+            flushable = canvas.remove_lines_at_top(event[1] - canvas_start)
+            flushable.write(output_stream)
+            canvas_start = event[1]
+    canvas.write(output_stream)
+    for line in lines:
+        print(line.rstrip("\n").expandtabs().rstrip(), file=output_stream)
+
+
+DEFAULT_IO_BUFFER_SIZE = 1024 * 1024
+
+# mode of the files wrapped by COMPRESSIONS
+BinaryMode = Literal["rb", "wb"]
+
+# Compression formats, with the regex matching the start of a compressed
+# stream and a function wrapping a binary file into a (de)compressing one.
+COMPRESSIONS: Dict[str, Tuple["re.Pattern[bytes]",
+                              Callable[[BinaryIO, BinaryMode], BinaryIO]]] = {
+    "gzip": (re.compile(b"\x1f\x8b\x08"),
+             lambda raw, mode: cast(BinaryIO, gzip.GzipFile(
+                 fileobj=raw, mode=mode, compresslevel=6))),
+    "bzip2": (re.compile(b"BZh[1-9](1AY&SY|\x17rE8P\x90)"),
+              lambda raw, mode: cast(BinaryIO, bz2.BZ2File(raw, mode))),
+    "xz": (re.compile(b"\xfd7zXZ\x00"),
+           lambda raw, mode: cast(BinaryIO, lzma.LZMAFile(raw, mode))),
+}
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".bz2": "bzip2", ".xz": "xz"}
+
+
+def detect_compression(head: bytes) -> Union[str, None]:
+    """Return the compression format of a stream starting with these bytes
+
+    Return None if the stream does not look compressed."""
+    for name, (magic, _) in COMPRESSIONS.items():
+        if magic.match(head):
+            return name
+    return None
+
+
+class _PrefixedReader(io.RawIOBase):
+    """A raw binary stream returning prefix, then the rest of stream"""
+    def __init__(self, prefix: bytes, stream: io.BufferedReader):
+        super().__init__()
+        self._prefix = prefix
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        """Read the prefix if any is left, else from the stream"""
+        if self._prefix:
+            data = self._prefix[:len(buffer)]
+            self._prefix = self._prefix[len(data):]
+        else:
+            data = self._stream.read1(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class InputError(Exception):
+    """The input could not be read or decompressed"""
+
+
+def read_input(input_stream: Iterable[str]) -> Iterator[str]:
+    """Iterate over the lines of the input, raising InputError if reading
+    or decompressing it fails"""
+    try:
+        yield from input_stream
+    except (EOFError, OSError, lzma.LZMAError) as err:
+        raise InputError(err) from err
+
+
+def open_input(path: str, stack: contextlib.ExitStack,
+               buffer_size: int = DEFAULT_IO_BUFFER_SIZE) -> TextIO:
+    """Open a text input, decompressing it if it is compressed
+
+    path "-" is the standard input.  Opened files are closed with stack."""
+    raw: io.BufferedReader
+    if path == "-":
+        raw = cast(io.BufferedReader, sys.stdin.buffer)
+    else:
+        raw = stack.enter_context(io.BufferedReader(io.FileIO(path, "rb"),
+                                                    buffer_size))
+    head = raw.peek(16)[:16]
+    replayed = len(head) < 16
+    if replayed:
+        # pipes may return fewer bytes.  Read them and give them back.
+        head = b""
+        while len(head) < 16:
+            data = raw.read1(16 - len(head))
+            if not data:
+                break
+            head += data
+        raw = io.BufferedReader(_PrefixedReader(head, raw), buffer_size)
+    compression = detect_compression(head)
+    if compression is None:
+        if path == "-":
+            if not replayed:
+                return sys.stdin
+            return stack.enter_context(io.TextIOWrapper(
+                raw, encoding=sys.stdin.encoding, errors=sys.stdin.errors))
+    else:
+        decompressed = COMPRESSIONS[compression][1](raw, "rb")
+        raw = stack.enter_context(io.BufferedReader(
+            cast(io.RawIOBase, decompressed), buffer_size))
+    return stack.enter_context(io.TextIOWrapper(raw))
+
+
+def open_output(path: str, stack: contextlib.ExitStack,
+                compression: Union[str, None] = "auto",
+                buffer_size: int = DEFAULT_IO_BUFFER_SIZE) -> TextIO:
+    """Open a text output, compressing it if requested
+
+    path "-" is the standard output.  compression is a key of COMPRESSIONS,
+    None for no compression, or "auto" to guess it from the extension of
+    path.  Opened files are closed and flushed with stack."""
+    if compression == "auto":
+        extension = os.path.splitext(path)[1]
+        compression = COMPRESSION_EXTENSIONS.get(extension)
+    if path == "-":
+        if compression is None:
+            return sys.stdout
+        raw = sys.stdout.buffer
+        stack.callback(raw.flush)
+    else:
+        raw = stack.enter_context(open(path, "wb", buffering=buffer_size))
+    if compression is not None:
+        compressed = COMPRESSIONS[compression][1](raw, "wb")
+        raw = stack.enter_context(io.BufferedWriter(
+            cast(io.RawIOBase, compressed), buffer_size))
+    return stack.enter_context(io.TextIOWrapper(raw))
+
+
+class _TeeWriter:
+    """A minimal text file-like object writing to an output and a copy
+
+    Errors writing the copy are remembered in 'failed' and otherwise
+    ignored."""
+    def __init__(self, output: TextIO, copy: TextIO):
+        self._output = output
+        self._copy = copy
+        self.failed = False
+
+    def write(self, text: str) -> int:
+        """Write text to both files"""
+        written = self._output.write(text)
+        if not self.failed:
+            try:
+                self._copy.write(text)
+            except OSError:
+                self.failed = True
+        return written
+
+    def flush(self) -> None:
+        """Flush the output"""
+        self._output.flush()
+
+
+class OutputCache:
+    """An on-disk cache of outputs, indexed by a hash of everything they
+    depend on
+
+    The cache is a directory with one file per output, named after the hex
+    digest of the key.  The total size of the files is kept below max_size
+    by removing the least recently used ones, according to their
+    modification time, which is updated on each use."""
+
+    VERSION = 1
+    ENCODING = "utf-8"
+    ERRORS = "surrogateescape"
+    ENTRY_RE = re.compile("[0-9a-f]{64}")
+
+    def __init__(self, directory: str, max_size: int):
+        self._directory = directory
+        self._max_size = max_size
+
+    @classmethod
+    def spool(cls, input_stream: Iterable[str], key_hash: Any,
+              stack: contextlib.ExitStack,
+              max_size: int) -> Tuple[Iterable[str], bool]:
+        """Copy the input to a temporary file while adding it to key_hash
+
+        Stop once more than max_size bytes were copied, so that large or
+        infinite inputs are still streamed.  Return the lines of the input,
+        starting with those of the temporary file, and whether the whole
+        input was copied.  The temporary file is deleted when stack is
+        closed."""
+        spooled = cast(TextIO, stack.enter_context(
+            tempfile.SpooledTemporaryFile(
+                max_size=DEFAULT_IO_BUFFER_SIZE * 8, mode="w+",
+                encoding=cls.ENCODING, errors=cls.ERRORS)))
+        lines = iter(input_stream)
+        size = 0
+        complete = True
+        for line in lines:
+            data = line.encode(cls.ENCODING, cls.ERRORS)
+            key_hash.update(data)
+            spooled.write(line)
+            size += len(data)
+            if size > max_size:
+                complete = False
+                break
+        spooled.seek(0)
+        return itertools.chain(spooled, lines), complete
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key)
+
+    def open(self, key: str) -> Union[TextIO, None]:
+        """Return the cached output for this key, or None"""
+        try:
+            cached = open(self._path(key), "r", encoding=self.ENCODING,
+                          errors=self.ERRORS, newline="")
+        except FileNotFoundError:
+            return None
+        with contextlib.suppress(OSError):
+            os.utime(self._path(key))
+        return cached
+
+    @contextlib.contextmanager
+    def store(self, key: str, output: TextIO) -> Iterator[TextIO]:
+        """Write to output while storing a copy in the cache.
+
+        The copy is only added to the cache if no exception is raised."""
+        os.makedirs(self._directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                "w", dir=self._directory, prefix=".tmp-", delete=False,
+                encoding=self.ENCODING, errors=self.ERRORS,
+                newline="") as copy:
+            tee = _TeeWriter(output, cast(TextIO, copy))
+            try:
+                yield cast(TextIO, tee)
+            except BaseException:
+                tee.failed = True
+                raise
+            finally:
+                if tee.failed:
+                    copy.close()
+                    os.unlink(copy.name)
+        if not tee.failed:
+            os.replace(copy.name, self._path(key))
+            self._evict()
+
+    def _evict(self) -> None:
+        """Remove the least recently used outputs above max_size"""
+        entries = []
+        with os.scandir(self._directory) as directory:
+            for entry in directory:
+                if self.ENTRY_RE.fullmatch(entry.name):
+                    with contextlib.suppress(OSError):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size,
+                                        entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self._max_size:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total_size -= size
+
+
+def iter_art_file(art_file: str,
+                  cache_size: int = 1024) -> Iterable[ReadOnlyCanvas]:
+    """Yield arts from an ASCII Art definition file or an art library
+
+    cache_size is the number of transparent arts whose masks are cached in
+    memory for art libraries."""
+    with open(art_file, 'rb') as binary_file:
+        if ArtLibrary.is_library(binary_file):
+            yield from ArtLibrary(binary_file, cache_size).arts()
+        else:
+            with io.TextIOWrapper(binary_file) as config_file:
+                yield from ArtParser.iter_file(config_file)
 
 
 def main() -> None:
     """Parse command line arguments and run the art sprinkler"""
     parser = argparse.ArgumentParser(
             description="sprinkle ASCII Art to standard input")
+    parser.add_argument("--input", metavar="input_file", type=str,
+                        default="-",
+                        help="""Read text from this file instead of standard
+                        input.  gzip, bzip2 and xz compressed input is
+                        decompressed automatically.""")
+    parser.add_argument("--output", metavar="output_file", type=str,
+                        default="-",
+                        help="""Write text to this file instead of standard
+                        output.""")
+    parser.add_argument("--compress", type=str, default="auto",
+                        choices=["auto", "none"] + list(COMPRESSIONS),
+                        help="""Compress the output.  The default is to
+                        guess from the extension of the output file.""")
+    parser.add_argument("--io-buffer-size", metavar="bytes", type=int,
+                        default=DEFAULT_IO_BUFFER_SIZE,
+                        help="""Size of the input and output buffers.""")
     parser.add_argument("--soft-max-width", metavar="soft_max_width", type=int,
                         default=80,
                         help="""Expected width of the text.  Art will be
@@ -783,31 +2394,299 @@ def main() -> None:
     parser.add_argument("--seed", metavar="seed", type=int,
                         help="""Seed the random generator with this value, to
                         always produce the same output.""")
-    parser.add_argument("art_file", metavar="<ASCII Art definition file>",
+    parser.add_argument("--density", metavar="density", type=float,
+                        help="""Maximum fraction of the white space, between
+                        0 and 1, that may be covered by art.""")
+    parser.add_argument("--max-arts-per-kline", metavar="count", type=float,
+                        help="""Maximum number of arts to sprinkle per 1000
+                        lines of text.""")
+    parser.add_argument("--time-budget-ms", metavar="milliseconds",
+                        type=float,
+                        help="""Stop sprinkling art after this time.  The
+                        rest of the text is copied unchanged.""")
+    parser.add_argument("--passthrough", metavar="regex", type=str,
+                        action="append", default=[],
+                        help="""Do not sprinkle art on lines matching this
+                        regular expression, for example '^[+-]' for lines
+                        of a diff.  Can be given multiple times.""")
+    parser.add_argument("--auto-tune", metavar="lines", type=int,
+                        help="""Choose the soft max width and how blanks are
+                        searched from this many lines at the start of the
+                        input.  This overrides --soft-max-width.  Tuning
+                        sprinkles these lines about ten times, and this
+                        time counts against --time-budget-ms.""")
+    parser.add_argument("--art", metavar="art_file", type=str,
+                        action="append", default=[],
+                        help="""Additional ASCII Art definition file.  Can be
+                        given multiple times to combine art sets.""")
+    parser.add_argument("--art-weight", metavar="weight", type=float,
+                        action="append", default=[],
+                        help="""Weight of the art set given by the --art
+                        option at the same position.  Art sets without a
+                        weight have a weight of 1.""")
+    parser.add_argument("--art-cache-size", metavar="count", type=int,
+                        default=1024,
+                        help="""Number of transparent arts from art libraries
+                        whose masks are kept in memory.""")
+    parser.add_argument("--compile-library", metavar="library_file",
                         type=str,
+                        help="""Instead of reading standard input, write all
+                        the arts to this file as an art library.  Art
+                        libraries can be used instead of ASCII Art
+                        definition files, and only load arts when they are
+                        sprinkled.""")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="""Read and write in separate threads, so that
+                        slow input or output does not stall sprinkling.""")
+    parser.add_argument("--pipeline-queue-size", metavar="count", type=int,
+                        default=16,
+                        help="""Maximum number of batches of lines waiting
+                        between two threads in pipelined mode.""")
+    parser.add_argument("--stats", action="store_true",
+                        help="""Print the time spent in each stage to
+                        standard error.""")
+    parser.add_argument("--cache-dir", metavar="directory", type=str,
+                        help="""Cache outputs in this directory, and reuse
+                        them when the same input is sprinkled with the same
+                        arts and options.  If --seed is not given, the seed
+                        is derived from the input, so the same input always
+                        gets the same art.""")
+    parser.add_argument("--cache-size", metavar="bytes", type=int,
+                        default=64 * 1024 * 1024,
+                        help="""Maximum size of the cache directory.  The
+                        least recently used outputs are removed first.""")
+    parser.add_argument("--trace", metavar="trace_file", type=str,
+                        help="""Record the blanks found and the arts tried
+                        in this file, as JSON lines.""")
+    parser.add_argument("--replay", metavar="trace_file", type=str,
+                        help="""Sprinkle the arts where they were sprinkled
+                        in this trace, recorded with --trace on the same
+                        input and arts, instead of searching for blanks.""")
+    parser.add_argument("art_file", metavar="<ASCII Art definition file>",
+                        type=str, nargs="?",
                         help="""Path to a file containing the ASCII Art to
                         sprinkle.  See the example files for documentation.""")
     args = parser.parse_args()
-    arts = None
-    try:
-        with open(args.art_file, 'r') as config_file:
-            arts = ArtParser.parse_file(config_file)
-    except OSError as err:
-        print(f"Cannot read file '{args.art_file}':", err, file=sys.stderr)
-        sys.exit(1)
-    except ArtSyntaxError as err:
-        print("Syntax error in", args.art_file, f"line {err.lineno}:",
-              err.error, file=sys.stderr)
-        if err.line is not None:
-            print(err.line, file=sys.stderr)
-        sys.exit(1)
-
-    rand = random.Random()
-    if "seed" in args:
-        rand.seed(args.seed)
-
-    sprinkle_art_on_stream(sys.stdin, sys.stdout, arts, rand,
-                           args.soft_max_width)
+    art_files = ([args.art_file] if args.art_file else []) + args.art
+    if not art_files:
+        parser.error("no ASCII Art definition file given")
+    if len(args.art_weight) > len(args.art):
+        parser.error("more --art-weight than --art options")
+    if any(weight <= 0 for weight in args.art_weight):
+        parser.error("--art-weight must be positive")
+    if args.density is not None and not 0 <= args.density <= 1:
+        parser.error("--density must be between 0 and 1")
+    if args.max_arts_per_kline is not None and args.max_arts_per_kline < 0:
+        parser.error("--max-arts-per-kline must not be negative")
+    if args.time_budget_ms is not None and args.time_budget_ms < 0:
+        parser.error("--time-budget-ms must not be negative")
+    for pattern in args.passthrough:
+        try:
+            re.compile(pattern)
+        except re.error as err:
+            parser.error(f"invalid --passthrough regex '{pattern}': {err}")
+    weights = [1.0] * (len(art_files) - len(args.art)) + args.art_weight
+    weights += [1.0] * (len(art_files) - len(weights))
+
+    if args.art_cache_size < 1:
+        parser.error("--art-cache-size must be positive")
+    if args.pipeline_queue_size < 1:
+        parser.error("--pipeline-queue-size must be positive")
+    if args.io_buffer_size < 1:
+        parser.error("--io-buffer-size must be positive")
+    if args.auto_tune is not None and args.auto_tune < 1:
+        parser.error("--auto-tune must be positive")
+    if args.cache_size < 0:
+        parser.error("--cache-size must not be negative")
+    if args.trace is not None and args.cache_dir is not None:
+        parser.error("--trace cannot be used with --cache-dir")
+    if args.replay is not None and (args.trace is not None
+                                    or args.cache_dir is not None
+                                    or args.pipeline):
+        parser.error("--replay cannot be used with --trace, --cache-dir or "
+                     "--pipeline")
+
+    def read_arts(art_file: str) -> Iterable[ReadOnlyCanvas]:
+        try:
+            yield from iter_art_file(art_file, args.art_cache_size)
+        except OSError as err:
+            print(f"Cannot read file '{art_file}':", err, file=sys.stderr)
+            sys.exit(1)
+        except ArtLibraryError as err:
+            print(f"Cannot read art library '{art_file}':", err,
+                  file=sys.stderr)
+            sys.exit(1)
+        except ArtSyntaxError as err:
+            print("Syntax error in", art_file, f"line {err.lineno}:",
+                  err.error, file=sys.stderr)
+            if err.line is not None:
+                print(err.line, file=sys.stderr)
+            sys.exit(1)
+
+    if args.compile_library is not None:
+        # write a temporary file first, so that errors do not leave a
+        # truncated library nor overwrite an existing one.
+        directory = os.path.dirname(os.path.abspath(args.compile_library))
+        umask = os.umask(0)
+        os.umask(umask)
+        try:
+            with tempfile.NamedTemporaryFile(
+                    "wb", dir=directory, prefix=".tmp-",
+                    delete=False) as library_file:
+                try:
+                    ArtLibrary.write(itertools.chain.from_iterable(
+                        read_arts(art_file) for art_file in art_files),
+                                     cast(BinaryIO, library_file))
+                    library_file.close()
+                    os.chmod(library_file.name, 0o666 & ~umask)
+                    os.replace(library_file.name, args.compile_library)
+                except BaseException:
+                    os.unlink(library_file.name)
+                    raise
+        except OSError as err:
+            print(f"Cannot write file '{args.compile_library}':", err,
+                  file=sys.stderr)
+            sys.exit(1)
+        return
+
+    stats = PipelineStats() if args.stats else None
+    with contextlib.ExitStack() as stack:
+        try:
+            input_stream = open_input(args.input, stack, args.io_buffer_size)
+        except OSError as err:
+            print(f"Cannot read file '{args.input}':", err, file=sys.stderr)
+            sys.exit(1)
+
+        lines: Iterable[str] = read_input(input_stream)
+        seed = args.seed
+        cache = None
+        cached = None
+        if args.cache_dir is not None:
+            cache = OutputCache(args.cache_dir, args.cache_size)
+            key_hash = hashlib.sha256()
+            options = {name: getattr(args, name) for name in (
+                "seed", "soft_max_width", "density", "max_arts_per_kline",
+                "time_budget_ms", "passthrough", "auto_tune")}
+            options["version"] = OutputCache.VERSION
+            options["arts"] = []
+            for art_file, weight in zip(art_files, weights):
+                digest = hashlib.sha256()
+                try:
+                    with open(art_file, "rb") as binary_file:
+                        for chunk in iter(functools.partial(
+                                binary_file.read, DEFAULT_IO_BUFFER_SIZE),
+                                b""):
+                            digest.update(chunk)
+                except OSError as err:
+                    print(f"Cannot read file '{art_file}':", err,
+                          file=sys.stderr)
+                    sys.exit(1)
+                options["arts"].append((digest.hexdigest(), weight))
+            key_hash.update(json.dumps(options, sort_keys=True).encode())
+            # outputs of inputs larger than the cache are not cached
+            try:
+                lines, complete = OutputCache.spool(lines, key_hash, stack,
+                                                    args.cache_size)
+            except InputError as err:
+                print(f"Cannot read file '{args.input}':", err,
+                      file=sys.stderr)
+                sys.exit(1)
+            cache_key = key_hash.hexdigest()
+            if seed is None:
+                seed = int(cache_key, 16)
+            if complete:
+                cached = cache.open(cache_key)
+                if cached is not None:
+                    stack.enter_context(cached)
+            else:
+                cache = None
+
+        if cached is None:
+            arts = ArtCatalogue()
+            for art_file, weight in zip(art_files, weights):
+                arts.add_arts(list(read_arts(art_file)), weight)
+        rand = KeyedRandom(seed)
+
+        settings = TunedSettings(args.soft_max_width)
+        time_budget_ms = args.time_budget_ms
+        # Replays and cached copies do not search for blanks
+        if (args.auto_tune is not None and cached is None
+                and args.replay is None):
+            tuning_start = time.monotonic()
+            lines = iter(lines)
+            try:
+                sample = list(itertools.islice(lines, args.auto_tune))
+            except InputError as err:
+                print(f"Cannot read file '{args.input}':", err,
+                      file=sys.stderr)
+                sys.exit(1)
+            lines = itertools.chain(sample, lines)
+            settings = auto_tune(sample, arts, args.passthrough)
+            if time_budget_ms is not None:
+                tuning_ms = (time.monotonic() - tuning_start) * 1000
+                time_budget_ms = max(0.0, time_budget_ms - tuning_ms)
+            if args.stats:
+                print(f"auto-tune: {settings}", file=sys.stderr)
+
+        try:
+            output_stream = open_output(
+                    args.output, stack,
+                    None if args.compress == "none" else args.compress,
+                    args.io_buffer_size)
+        except OSError as err:
+            print(f"Cannot write file '{args.output}':", err,
+                  file=sys.stderr)
+            sys.exit(1)
+
+        if cache is not None and cached is None:
+            output_stream = stack.enter_context(
+                cache.store(cache_key, output_stream))
+
+        trace = None
+        try:
+            if args.trace is not None:
+                trace = PlacementTrace(stack.enter_context(
+                    open(args.trace, "w", buffering=args.io_buffer_size)))
+            elif args.replay is not None:
+                trace_stream = stack.enter_context(open(args.replay))
+        except OSError as err:
+            print(f"Cannot open file '{args.trace or args.replay}':", err,
+                  file=sys.stderr)
+            sys.exit(1)
+
+        try:
+            if cached is not None:
+                shutil.copyfileobj(cached, output_stream)
+            elif args.replay is not None:
+                replay_placements(lines, output_stream, arts, trace_stream)
+            elif args.pipeline:
+                sprinkle_art_on_stream_pipelined(
+                        lines, output_stream, arts, rand,
+                        soft_max_width=settings.soft_max_width,
+                        density=args.density,
+                        max_arts_per_kline=args.max_arts_per_kline,
+                        stats=stats, queue_size=args.pipeline_queue_size,
+                        time_budget_ms=time_budget_ms,
+                        passthrough=args.passthrough, trace=trace,
+                        minimum_blank_width=settings.minimum_blank_width,
+                        maximum_blank_height=settings.maximum_blank_height)
+            else:
+                sprinkle_art_on_stream(
+                        lines, output_stream, arts, rand,
+                        settings.soft_max_width, args.density,
+                        args.max_arts_per_kline, stats=stats,
+                        time_budget_ms=time_budget_ms,
+                        passthrough=args.passthrough, trace=trace,
+                        minimum_blank_width=settings.minimum_blank_width,
+                        maximum_blank_height=settings.maximum_blank_height)
+        except PlacementTraceError as err:
+            print(f"Invalid trace '{args.replay}':", err, file=sys.stderr)
+            sys.exit(1)
+        except InputError as err:
+            print(f"Cannot read file '{args.input}':", err, file=sys.stderr)
+            sys.exit(1)
+    if stats is not None:
+        print(stats.report(), file=sys.stderr)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,33 @@
 #!/usr/bin/python3
 # SPDX-License-Identifier: AGPL-3.0-only
+import io
+import os
+import sys
+import time
+import bz2
+import gzip
+import lzma
+import hashlib
+import itertools
+import random
+import tempfile
+import threading
+import subprocess
 import unittest
-from ascii_art_sprinkler import Rect, BlankFinder, AsciiCanvas
+import unittest.mock
+import contextlib
+import concurrent.futures
+import tracemalloc
+from ascii_art_sprinkler import Rect, BlankFinder, AsciiCanvas, ArtCatalogue
+from ascii_art_sprinkler import PlacementQuota, ArtParser, ArtLibrary
+from ascii_art_sprinkler import KeyedRandom, ArtLibraryError
+from ascii_art_sprinkler import sprinkle_art_on_stream
+from ascii_art_sprinkler import sprinkle_art_on_stream_pipelined
+from ascii_art_sprinkler import open_input, open_output, detect_compression
+from ascii_art_sprinkler import OutputCache, PipelineStats
+from ascii_art_sprinkler import InputError, read_input
+from ascii_art_sprinkler import PlacementTrace, PlacementTraceError
+from ascii_art_sprinkler import replay_placements, auto_tune
 
 def blank_finder_for(string):
     finder = BlankFinder(80, 1, 999)
@@ -200,5 +226,624 @@ This is a test of the blank finder.
 Don't pay attention !
 """))
 
+class TestKeyedRandom(unittest.TestCase):
+    def draws(self, stream):
+        return [stream.randint(0, 1000) for _ in range(20)]
+
+    def test_order_independent(self):
+        first = KeyedRandom(42)
+        a_then_b = [self.draws(first.stream(1, 2)),
+                    self.draws(first.stream(3, 4))]
+        second = KeyedRandom(42)
+        b_then_a = [self.draws(second.stream(3, 4)),
+                    self.draws(second.stream(1, 2))]
+        self.assertEqual(a_then_b, b_then_a[::-1])
+        self.assertNotEqual(a_then_b[0], a_then_b[1])
+        self.assertNotEqual(self.draws(KeyedRandom(43).stream(1, 2)),
+                            a_then_b[0])
+
+    def test_choices(self):
+        stream = KeyedRandom(1).stream(0)
+        picks = [stream.choices("ab", cum_weights=[1, 4])[0]
+                 for _ in range(1000)]
+        self.assertTrue(600 < picks.count("b") < 900)
+        self.assertTrue(all(0 <= stream.randint(3, 5) - 3 <= 2
+                            for _ in range(100)))
+
+
+class TestSkipLines(unittest.TestCase):
+    def test_can_skip_line(self):
+        finder = BlankFinder(80, 3, 999)
+        self.assertTrue(finder.can_skip_line("x" * 81))
+        self.assertTrue(finder.can_skip_line("x" * 40 + "  " + "x" * 40))
+        self.assertTrue(finder.can_skip_line("x" * 80 + "   x"))
+        self.assertTrue(finder.can_skip_line("x" * 78 + " "))
+        self.assertFalse(finder.can_skip_line("x" * 40 + "   " + "x" * 40))
+        self.assertFalse(finder.can_skip_line("x" * 77))
+
+    def test_passthrough(self):
+        arts = ArtParser.parse_file(io.StringIO("## margin=0\n\n*\n"))
+        text = ["\n", "+\n", "\n", "\n", "-\n", "\n"] * 10
+        output = io.StringIO()
+        sprinkle_art_on_stream(iter(text), output, arts, random.Random(1),
+                               passthrough=["^[+-]"])
+        lines = output.getvalue().split("\n")[:-1]
+        self.assertEqual(len(lines), len(text))
+        self.assertIn("*", output.getvalue())
+        for line, expected in zip(lines, text):
+            if expected in ("+\n", "-\n"):
+                self.assertEqual(line, expected[0])
+
+    def test_stats(self):
+        arts = ArtParser.parse_file(io.StringIO("## margin=0\n\n*\n"))
+        text = ["\n", "+\n", "\n", "x" * 100 + "\n", "-\n", "\n"] * 10
+        for time_budget_ms in (None, 0):
+            stats = PipelineStats()
+            sprinkle_art_on_stream(iter(text), io.StringIO(), arts,
+                                   random.Random(1), passthrough=["^[+-]"],
+                                   stats=stats,
+                                   time_budget_ms=time_budget_ms)
+            self.assertEqual(stats.find.items, len(text))
+
+
+class TestAutoTune(unittest.TestCase):
+    def test_soft_max_width(self):
+        finder = BlankFinder(20, 1, 999)
+        finder.add_line("x" * 10)
+        finder.end_of_file()
+        self.assertEqual([rect.x_axis() for rect in
+                          finder.drain_fillable_blanks()], [(10, 20)])
+        self.assertTrue(BlankFinder(20, 3, 999).can_skip_line("x" * 18))
+
+    def test_auto_tune(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n\n<>\n\n<==>\n"))
+        wide = auto_tune(random_text(300, 200), arts)
+        self.assertGreaterEqual(wide.soft_max_width, 180)
+        self.assertEqual(auto_tune(random_text(300, 200), arts), wide)
+        narrow = auto_tune(random_text(300, 30), arts)
+        self.assertLessEqual(narrow.soft_max_width, 40)
+        widths = {art.width() for art in arts}
+        for settings in (wide, narrow):
+            self.assertIn(settings.minimum_blank_width, widths)
+            self.assertGreaterEqual(settings.maximum_blank_height, 2)
+
+    def test_maximum_blank_height(self):
+        arts = ArtParser.parse_file(io.StringIO("|\n|\n|\n"))
+        with self.assertRaises(ValueError):
+            sprinkle_art_on_stream(iter([]), io.StringIO(), arts,
+                                   random.Random(1), maximum_blank_height=2)
+
+
+class TestTransparency(unittest.TestCase):
+    STAR = as_art("""
+## margin=0
+## transparent
+
+ |
+-#-
+ |
+""")
+
+    def test_masks(self):
+        star, = ArtParser.parse_file(io.StringIO(self.STAR))
+        self.assertEqual(star.transparency_masks(), [0b010, 0b111, 0b010])
+        star.make_transparent(1)
+        self.assertEqual(star.transparency_masks(), [0b111, 0b111, 0b111])
+
+    def test_fill_over_text(self):
+        star, = ArtParser.parse_file(io.StringIO(self.STAR))
+        finder = blank_finder_for("ab cd\na   d\nab cd\n")
+        self.assertTrue(finder.try_fill_blank(Rect(1, 4, 1, 4), star))
+        self.assertFalse(finder.try_fill_blank(Rect(0, 3, 1, 4), star))
+        output = io.StringIO()
+        list(finder.drain_fillable_blanks())
+        finder.flush_canvas(output)
+        self.assertEqual(output.getvalue(), "ab|cd\na-#-d\nab|cd\n\n")
+
+    def test_catalogue(self):
+        star, = ArtParser.parse_file(io.StringIO(self.STAR))
+        catalogue = ArtCatalogue([star])
+        self.assertEqual(catalogue.min_width(), 2)
+        self.assertEqual(catalogue.fittable_arts(2, 2), ([star], None))
+        self.assertEqual(catalogue.fittable_arts(1, 3), ([], None))
+
+    def test_line_masks(self):
+        canvas = AsciiCanvas(6, 0)
+        for line in ("a    b", "", "  c"):
+            canvas.add_line(line, False)
+        canvas.blit(AsciiCanvas.from_text("x"), 3, 1)
+        self.assertFalse(canvas.is_rectangle_free_under(Rect(1, 4, 1, 2),
+                                                        [0b100]))
+        self.assertTrue(canvas.is_rectangle_free_under(Rect(1, 4, 1, 2),
+                                                       [0b011]))
+        canvas.remove_lines_at_top(1)
+        self.assertFalse(canvas.is_rectangle_free_under(Rect(2, 4, 0, 2),
+                                                        [0b00, 0b01]))
+        self.assertTrue(canvas.is_rectangle_free_under(Rect(2, 4, 0, 2),
+                                                       [0b01, 0b10]))
+
+
+class TestArtCatalogue(unittest.TestCase):
+    def test_fittable(self):
+        small = AsciiCanvas.from_text("*")
+        wide = AsciiCanvas.from_text("<><")
+        tall = AsciiCanvas.from_text("|\n|")
+        catalogue = ArtCatalogue([small, wide, tall])
+        self.assertEqual(catalogue.fittable_arts(1, 1), ([small], None))
+        self.assertEqual(catalogue.fittable_arts(3, 1), ([small, wide], None))
+        self.assertEqual(catalogue.fittable_arts(80, 80),
+                         ([small, wide, tall], None))
+        self.assertEqual(catalogue.fittable_arts(0, 80), ([], None))
+
+    def test_weights(self):
+        small = AsciiCanvas.from_text("*")
+        wide = AsciiCanvas.from_text("<><")
+        tall = AsciiCanvas.from_text("|\n|")
+        catalogue = ArtCatalogue([small, wide])
+        catalogue.add_arts([tall], 3)
+        self.assertEqual(catalogue.fittable_arts(3, 2),
+                         ([small, wide, tall], [0.5, 1, 4]))
+        self.assertEqual(catalogue.fittable_arts(1, 2),
+                         ([small, tall], [0.5, 3.5]))
+
+
+class TestPlacementQuota(unittest.TestCase):
+    def test_density(self):
+        quota = PlacementQuota(10, density=0.5)
+        self.assertTrue(quota.exhausted())
+        quota.add_line("abcd  ")
+        self.assertFalse(quota.exhausted())
+        quota.art_placed(AsciiCanvas.from_text("**"))
+        self.assertFalse(quota.exhausted())
+        quota.art_placed(AsciiCanvas.from_text("*"))
+        self.assertTrue(quota.exhausted())
+
+    def test_arts_per_kline(self):
+        quota = PlacementQuota(80, max_arts_per_kline=2)
+        quota.add_line("")
+        self.assertFalse(quota.exhausted())
+        quota.art_placed(AsciiCanvas.from_text("*"))
+        self.assertTrue(quota.exhausted())
+        for _ in range(999):
+            quota.add_line("")
+        self.assertFalse(quota.exhausted())
+
+
+class TestArtLibrary(unittest.TestCase):
+    def test_round_trip(self):
+        arts = ArtParser.parse_file(io.StringIO(as_art("""
+## mirror_x: <> *
+## transparent
+## width=5
+
+<*
+
+|
+|
+""")))
+        with tempfile.TemporaryFile() as library_file:
+            self.assertEqual(ArtLibrary.write(arts, library_file), 3)
+            library_file.seek(0)
+            self.assertTrue(ArtLibrary.is_library(library_file))
+            library = ArtLibrary(library_file, cache_size=1)
+        loaded = library.arts()
+        self.assertEqual([(art.width(), art.height()) for art in loaded],
+                         [(art.width(), art.height()) for art in arts])
+        for art, loaded_art in zip(arts, loaded):
+            for y in range(art.height()):
+                self.assertEqual(loaded_art.line(y), art.line(y))
+                self.assertEqual(loaded_art.line(y, justified=False),
+                                 art.line(y, justified=False))
+            self.assertEqual(loaded_art.transparency_masks(),
+                             art.transparency_masks())
+        with self.assertRaises(IndexError):
+            loaded[2].line(arts[2].height())
+
+    def test_no_copies(self):
+        arts = [AsciiCanvas.from_text("é\n  <>"), AsciiCanvas.from_text("*")]
+        library_file = io.BytesIO()
+        ArtLibrary.write(arts, library_file)
+        library = ArtLibrary(library_file.getvalue())
+        canvas = AsciiCanvas(4, 2)
+        for art in library.arts():
+            canvas.blit(art, 0, 0)
+        self.assertEqual([canvas.line(y) for y in range(2)],
+                         ["*   ", "  <>"])
+        self.assertEqual(library.transparency_masks.cache_info().currsize, 0)
+
+    def test_failed_attempt(self):
+        library_file = io.BytesIO()
+        ArtLibrary.write([AsciiCanvas.from_text("<>")], library_file)
+        library = ArtLibrary(library_file.getvalue())
+        finder = blank_finder_for("ab\n")
+        with unittest.mock.patch.object(library, "load",
+                                        side_effect=AssertionError):
+            self.assertFalse(finder.try_fill_blank(Rect(0, 2, 0, 1),
+                                                   library.arts()[0]))
+
+
+def shared_art_lines(name):
+    catalogue = ArtCatalogue.from_shared_memory(name)
+    lines = [[art.line(y) for y in range(art.height())]
+             for art in catalogue.arts()]
+    catalogue.close()
+    return lines
+
+
+class TestSharedCatalogue(unittest.TestCase):
+    def setUp(self):
+        self.catalogue = ArtCatalogue()
+        self.catalogue.add_arts(ArtParser.parse_file(io.StringIO(
+            "## mirror_x: <>\n## transparent\n\n<*\n\n|\n|\n")))
+        self.catalogue.add_arts([AsciiCanvas.from_text("x")], 3)
+        self.shared = self.catalogue.to_shared_memory()
+        self.addCleanup(self.shared.unlink)
+        self.addCleanup(self.shared.close)
+
+    def test_attach(self):
+        attached = ArtCatalogue.from_shared_memory(self.shared.name)
+        self.assertEqual(len(attached), len(self.catalogue))
+        for art, shared_art in zip(self.catalogue.arts(), attached.arts()):
+            self.assertEqual((shared_art.width(), shared_art.height()),
+                             (art.width(), art.height()))
+            self.assertEqual(shared_art.line(0), art.line(0))
+            self.assertEqual(shared_art.transparency_masks(),
+                             art.transparency_masks())
+        self.assertEqual(attached.fittable_arts(5, 5),
+                         (attached.arts(),
+                          self.catalogue.fittable_arts(5, 5)[1]))
+
+    def test_worker_processes(self):
+        expected = shared_art_lines(self.shared.name)
+        with concurrent.futures.ProcessPoolExecutor(2) as pool:
+            for lines in pool.map(shared_art_lines, [self.shared.name] * 2):
+                self.assertEqual(lines, expected)
+
+    def test_separate_processes(self):
+        script = ("import sys, ascii_art_sprinkler as s\n"
+                  "s.ArtCatalogue.from_shared_memory(sys.argv[1]).close()\n")
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for _ in range(2):
+            subprocess.run([sys.executable, "-c", script, self.shared.name],
+                           cwd=directory, check=True)
+        self.assertEqual(len(shared_art_lines(self.shared.name)),
+                         len(self.catalogue))
+
+    def test_fork_pool(self):
+        # the resource tracker of the creator reports errors on stderr
+        script = """if True:
+            import io, multiprocessing
+            from ascii_art_sprinkler import ArtCatalogue, AsciiCanvas
+            def attach(name):
+                ArtCatalogue.from_shared_memory(name).close()
+            catalogue = ArtCatalogue([AsciiCanvas.from_text("x")])
+            shared = catalogue.to_shared_memory()
+            with multiprocessing.get_context("fork").Pool(3) as pool:
+                pool.map(attach, [shared.name] * 6)
+            ArtCatalogue.from_shared_memory(shared.name).close()
+            shared.close()
+            shared.unlink()
+        """
+        directory = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run([sys.executable, "-c", script],
+                                cwd=directory, capture_output=True,
+                                text=True, check=True)
+        self.assertEqual(result.stderr, "")
+
+    def test_close(self):
+        attached = ArtCatalogue.from_shared_memory(self.shared.name)
+        attached.close()
+        self.assertEqual(len(attached), 0)
+        self.assertEqual(attached.fittable_arts(5, 5), ([], None))
+        attached.close()
+        self.catalogue.close()
+        self.assertEqual(len(self.catalogue), 3)
+
+    def test_invalid(self):
+        self.shared.buf[8] = 0
+        with self.assertRaises(ArtLibraryError):
+            ArtCatalogue.from_shared_memory(self.shared.name)
+
+
+def random_text(lines, width, seed=0):
+    """Generate text with words and blanks of various sizes"""
+    rand = random.Random(seed)
+    text = []
+    for _ in range(lines):
+        line = ""
+        line_width = rand.randint(0, width)
+        while len(line) < line_width:
+            line += rand.choice(["word", "x", "longer_word", "=="])
+            line += " " * rand.choice([1, 1, 1, 2, 5, 12])
+        text.append(line[:line_width].rstrip() + "\n")
+    return text
+
+
+class TestTimeBudget(unittest.TestCase):
+    def test_no_time(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n"))
+        text = random_text(200, 80) + ["\ttab\n"]
+        output = io.StringIO()
+        sprinkle_art_on_stream(iter(text), output, arts, random.Random(1),
+                               time_budget_ms=0)
+        self.assertEqual(output.getvalue(),
+                         "".join(text).replace("\t", " " * 8))
+
+    def test_enough_time(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n"))
+        output = io.StringIO()
+        sprinkle_art_on_stream(iter(["", "", ""]), output, arts,
+                               random.Random(1), time_budget_ms=60000)
+        self.assertIn("*", output.getvalue())
+
+
+class TestPipeline(unittest.TestCase):
+    def test_same_output(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n\n<>\n"))
+        text = random_text(2000, 80)
+        expected = io.StringIO()
+        sprinkle_art_on_stream(iter(text), expected, arts, random.Random(1))
+        output = io.StringIO()
+        stats = sprinkle_art_on_stream_pipelined(
+                iter(text), output, arts, random.Random(1),
+                queue_size=2, batch_size=10)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+        self.assertEqual(stats.read.items, 2000)
+        self.assertEqual(stats.find.items, 2000)
+        self.assertLessEqual(stats.input_queue.max_depth, 2)
+
+    def test_read_error(self):
+        def failing_input():
+            yield "line\n"
+            raise OSError("cannot read")
+        arts = ArtParser.parse_file(io.StringIO("*\n"))
+        with self.assertRaises(OSError):
+            sprinkle_art_on_stream_pipelined(failing_input(), io.StringIO(),
+                                             arts, random.Random(1))
+
+    def test_sprinkle_error(self):
+        arts = ArtParser.parse_file(io.StringIO("|\n|\n|\n"))
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                sprinkle_art_on_stream_pipelined(
+                        itertools.repeat("line\n"), io.StringIO(), arts,
+                        random.Random(1), queue_size=1,
+                        maximum_blank_height=2)
+        self.assertEqual([thread.name for thread in threading.enumerate()
+                          if thread.name.startswith("sprinkler-")], [])
+
+
+class TestPlacementTrace(unittest.TestCase):
+    def test_replay(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n\n<>\n\n/\\\n\\/\n"))
+        text = random_text(500, 80) + ["x" * 100 + "\n"] * 10 + ["\n"]
+        expected = io.StringIO()
+        trace_stream = io.StringIO()
+        sprinkle_art_on_stream(iter(text), expected, arts, random.Random(1),
+                               passthrough=["^#"],
+                               trace=PlacementTrace(trace_stream))
+        trace_stream.seek(0)
+        events = list(PlacementTrace.read(trace_stream))
+        kinds = {event[0] for event in events}
+        self.assertEqual(kinds, {"blank", "place", "miss", "flush"})
+        self.assertEqual(events[-1], ["flush", len(text) + 1])
+        output = io.StringIO()
+        trace_stream.seek(0)
+        replay_placements(iter(text), output, arts, trace_stream)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_invalid(self):
+        arts = ArtParser.parse_file(io.StringIO("*\n"))
+        for trace in ('["place",0,1,1,2,0]\n', '["place",0,1,1,2,5]\n',
+                      '["flush",1]\n["flush",3]\n["place",0,1,1,2,0]\n',
+                      '["fill",0]\n', '["flush","1"]\n', '{"flush"\n'):
+            with self.assertRaises(PlacementTraceError):
+                replay_placements(iter([]), io.StringIO(), arts,
+                                  io.StringIO(trace))
+
+
+class TestCompression(unittest.TestCase):
+    def test_detect(self):
+        self.assertIsNone(detect_compression(b"BZh, not bzip2"))
+        self.assertIsNone(detect_compression(b""))
+
+    def test_round_trip(self):
+        text = "".join(random_text(100, 80))
+        with tempfile.TemporaryDirectory() as directory:
+            for extension in (".gz", ".bz2", ".xz", ".txt"):
+                path = os.path.join(directory, "text" + extension)
+                with contextlib.ExitStack() as stack:
+                    open_output(path, stack, buffer_size=10).write(text)
+                with contextlib.ExitStack() as stack:
+                    self.assertEqual(open_input(path, stack).read(), text)
+                with open(path, "rb") as compressed:
+                    self.assertEqual(extension == ".txt",
+                                     compressed.read() == text.encode())
+
+    def test_truncated(self):
+        text = "".join(random_text(100, 80)).encode()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "text")
+            for compress in (gzip.compress, bz2.compress, lzma.compress,
+                             lambda data: b"\x1f\x8b\x08" + data):
+                with open(path, "wb") as compressed:
+                    compressed.write(compress(text)[:200])
+                with contextlib.ExitStack() as stack:
+                    with self.assertRaises(InputError):
+                        list(read_input(open_input(path, stack)))
+
+
+class ShortReads(io.RawIOBase):
+    """A raw stream returning at most two bytes per read, like a pipe"""
+    def __init__(self, data):
+        super().__init__()
+        self._data = data
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._data[:min(2, len(buffer))]
+        self._data = self._data[len(data):]
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class TestShortReads(unittest.TestCase):
+    def test_detect_compression(self):
+        text = "".join(random_text(100, 80))
+        for compressed in (gzip.compress(text.encode()), text.encode(),
+                           b"x"):
+            stdin = io.TextIOWrapper(io.BufferedReader(ShortReads(
+                compressed)))
+            with unittest.mock.patch("sys.stdin", stdin):
+                with contextlib.ExitStack() as stack:
+                    self.assertEqual(open_input("-", stack).read(),
+                                     gzip.decompress(compressed).decode()
+                                     if compressed[:1] == b"\x1f"
+                                     else compressed.decode())
+
+
+class TestOutputCache(unittest.TestCase):
+    def store(self, cache, key, text):
+        output = io.StringIO()
+        with cache.store(key, output) as tee:
+            tee.write(text)
+        self.assertEqual(output.getvalue(), text)
+
+    def test_store_and_open(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = OutputCache(directory, 1000)
+            self.assertIsNone(cache.open("0" * 64))
+            self.store(cache, "0" * 64, "hello\r\nworld\n")
+            with cache.open("0" * 64) as cached:
+                self.assertEqual(cached.read(), "hello\r\nworld\n")
+            with self.assertRaises(ValueError):
+                with cache.store("1" * 64, io.StringIO()) as tee:
+                    tee.write("partial")
+                    raise ValueError
+            self.assertIsNone(cache.open("1" * 64))
+            self.assertEqual(os.listdir(directory), ["0" * 64])
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = OutputCache(directory, 350)
+            for index, key in enumerate(("a" * 64, "b" * 64, "c" * 64)):
+                self.store(cache, key, "x" * 100)
+                os.utime(os.path.join(directory, key), (index, index))
+            cache.open("a" * 64).close()
+            self.store(cache, "d" * 64, "x" * 100)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ["a" * 64, "c" * 64, "d" * 64])
+
+    def test_spool(self):
+        key_hash = hashlib.sha256()
+        with contextlib.ExitStack() as stack:
+            lines, complete = OutputCache.spool(["a\n", "b\n"], key_hash,
+                                                stack, 4)
+            self.assertEqual(list(lines), ["a\n", "b\n"])
+            self.assertTrue(complete)
+        self.assertEqual(key_hash.digest(),
+                         hashlib.sha256(b"a\nb\n").digest())
+
+    def test_spool_limit(self):
+        def infinite_input():
+            while True:
+                yield "line\n"
+        with contextlib.ExitStack() as stack:
+            lines, complete = OutputCache.spool(infinite_input(),
+                                                hashlib.sha256(), stack, 100)
+            self.assertFalse(complete)
+            self.assertEqual(list(itertools.islice(lines, 1000)),
+                             ["line\n"] * 1000)
+
+
+class TestScaling(unittest.TestCase):
+    """Check that the run time grows linearly with the input size and that
+    memory usage does not grow with the input length.
+
+    The thresholds are much larger than the expected ratio, so that only
+    regressions to quadratic behavior are reported."""
+
+    ARTS = ArtParser.parse_file(io.StringIO(as_art("""
+*
+
+ |
+-#-
+ |
+
+\\-_  _-/
+ \\ -- /
+""")))
+
+    @staticmethod
+    def best_time(function, *args, repeat=3):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    @staticmethod
+    def find_blanks(text, width):
+        finder = BlankFinder(width, 1, 15)
+        with open(os.devnull, "w") as output:
+            for line in text:
+                finder.add_line(line.rstrip("\n"))
+                list(finder.drain_fillable_blanks())
+                finder.flush_canvas(output)
+            finder.end_of_file()
+            list(finder.drain_fillable_blanks())
+            finder.flush_canvas(output)
+
+    @classmethod
+    def sprinkle(cls, text, width):
+        with open(os.devnull, "w") as output:
+            sprinkle_art_on_stream(iter(text), output, cls.ARTS,
+                                   random.Random(0), width)
+
+    def assert_linear_in_lines(self, function):
+        small = self.best_time(function, random_text(500, 80), 80)
+        large = self.best_time(function, random_text(5000, 80), 80, repeat=1)
+        self.assertLess(large / small, 30)
+
+    def assert_linear_in_width(self, function):
+        narrow = self.best_time(function, random_text(500, 80), 80)
+        wide = self.best_time(function, random_text(500, 400), 400)
+        self.assertLess(wide / narrow, 15)
+
+    def assert_bounded_memory(self, function):
+        peaks = []
+        for lines in (1000, 5000):
+            text = random_text(lines, 80)
+            tracemalloc.start()
+            try:
+                function(text, 80)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        self.assertLess(peaks[1], peaks[0] * 2)
+
+    def test_blank_finder_lines(self):
+        self.assert_linear_in_lines(self.find_blanks)
+
+    def test_blank_finder_width(self):
+        self.assert_linear_in_width(self.find_blanks)
+
+    def test_blank_finder_memory(self):
+        self.assert_bounded_memory(self.find_blanks)
+
+    def test_sprinkle_lines(self):
+        self.assert_linear_in_lines(self.sprinkle)
+
+    def test_sprinkle_width(self):
+        self.assert_linear_in_width(self.sprinkle)
+
+    def test_sprinkle_memory(self):
+        self.assert_bounded_memory(self.sprinkle)
+
+
 if __name__ == '__main__':
     unittest.main()